@@ -0,0 +1,36 @@
+# Arithmetic backend
+# The big integer operations the primality and factoring tests spend their
+# time in, from gmpy2 (GMP) where it is installed and from Python's own
+# integers otherwise. The choice is made once, when this module is
+# imported, so the tests call straight into whichever is available.
+#
+#   isqrt(n)                    integer square root
+#   powmod(b, e, m)             b^e mod m
+#   is_strong_prp(n, a)         strong probable prime test to base a
+#   is_strong_selfridge_prp(n)  strong Lucas test, Selfridge's parameters
+#
+# The last two are None without gmpy2, for the caller's own versions.
+# This is for the scripts that run on the client; the functions dispy
+# ships to the nodes have to be self-contained, so they choose for
+# themselves, once per job.
+#
+# Usage:
+#   from arithmetic import isqrt, powmod
+
+import math
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+if gmpy2 is not None:
+    isqrt = gmpy2.isqrt
+    powmod = gmpy2.powmod
+    is_strong_prp = gmpy2.is_strong_prp
+    is_strong_selfridge_prp = gmpy2.is_strong_selfridge_prp
+else:
+    isqrt = math.isqrt
+    powmod = pow
+    is_strong_prp = None
+    is_strong_selfridge_prp = None
@@ -0,0 +1,49 @@
+# Modular exponentiation benchmark
+# This code times a^e mod n, the operation that dominates the Fermat,
+# Miller-Rabin and deterministic primality tests, for each arithmetic
+# backend the tests can use: Python's built in pow, and gmpy2's powmod
+# where gmpy2 is installed. It runs on the OctaPi client standalone, so
+# that the backends can be compared on the hardware the tests run on.
+#
+# Usage: python3 benchmark_modexp.py [--bits 64 128 256] [--seconds 1.0]
+
+# time 'powmod' on random odd moduli of the given size, with full size
+# exponents as in a Fermat test; returns operations per second
+def modexp_rate(powmod, convert, bits, seconds):
+    import random, time
+
+    rng = random.Random(bits)
+    cases = []
+    for i in range(64):
+        modulus = rng.getrandbits(bits) | (1 << (bits - 1)) | 1
+        cases.append((convert(rng.randrange(2, modulus - 1)), convert(modulus - 1), convert(modulus)))
+
+    count = 0
+    start = time.perf_counter()
+    while (time.perf_counter() - start) < seconds:
+        for base, exponent, modulus in cases:
+            powmod(base, exponent, modulus)
+        count += len(cases)
+    return count / (time.perf_counter() - start)
+
+
+# main
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bits", type=int, nargs="+", default=[64, 128, 256], help="modulus sizes to time")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent on each backend and size")
+    args = parser.parse_args()
+
+    backends = [('python pow', pow, int)]
+    try:
+        import gmpy2
+        backends.append(('gmpy2 powmod', gmpy2.powmod, gmpy2.mpz))
+    except ImportError:
+        print('gmpy2 is not installed, only the built in pow is timed')
+
+    print(('%-14s' % 'backend') + ''.join([('%14s' % ('%i bit' % bits)) for bits in args.bits]))
+    for name, powmod, convert in backends:
+        rates = [modexp_rate(powmod, convert, bits, args.seconds) for bits in args.bits]
+        print(('%-14s' % name) + ''.join([('%14s' % ('%.0f/s' % rate)) for rate in rates]))
@@ -0,0 +1,86 @@
+# Checkpoints for the long range searches
+# factor_efficient.py and primality_efficient.py keep their progress in a
+# small JSON file as they go, so that a client that dies after hours can
+# carry on with --resume instead of starting again. The file holds the
+# ranges finished so far as an interval set (a few [lower, upper] runs
+# however many jobs went into them), the ranges of the jobs that were in
+# flight, which a resumed run submits again, and the results so far.
+# It is written to a temporary file that then replaces the old one, so a
+# crash part way through a write leaves the previous checkpoint intact.
+#
+# Usage:
+#   done = IntervalSet(step=2)    # ranges of odd numbers
+#   done.add(101, 199)
+#   list(done.gaps(1, 301))       # [(1, 99), (201, 301)]
+#   saver = Checkpoint('run.checkpoint', interval=60)
+#   if saver.due(): saver.save({'done': done.runs})
+#   state = load('run.checkpoint')
+
+import os, json, time, tempfile, bisect
+
+# a set of integers lower, lower + step, ... upper kept as sorted runs
+# [lower, upper]; runs that overlap, or touch at 'step', are merged
+class IntervalSet(object):
+    def __init__(self, runs=(), step=1):
+        self.step = step
+        self.runs = []
+        for lower, upper in runs:
+            self.add(lower, upper)
+
+    def add(self, lower, upper):
+        step = self.step
+        i = bisect.bisect_left(self.runs, [lower, lower])
+        if (i > 0) and (self.runs[i - 1][1] + step >= lower):
+            i -= 1
+        j = i
+        while (j < len(self.runs)) and (self.runs[j][0] <= upper + step):
+            lower = min(lower, self.runs[j][0])
+            upper = max(upper, self.runs[j][1])
+            j += 1
+        self.runs[i:j] = [[lower, upper]]
+
+    # the pieces of lower .. upper not in the set, in ascending order
+    def gaps(self, lower, upper):
+        i = max(bisect.bisect_left(self.runs, [lower, lower]) - 1, 0)
+        while (i < len(self.runs)) and (self.runs[i][0] <= upper):
+            run_lower, run_upper = self.runs[i]
+            if (run_upper >= lower):
+                if (run_lower > lower):
+                    yield (lower, run_lower - self.step)
+                lower = run_upper + self.step
+            i += 1
+        if (lower <= upper):
+            yield (lower, upper)
+
+    # the span of the runs, in the units of upper - lower + 1
+    def size(self):
+        return sum([upper - lower + 1 for lower, upper in self.runs])
+
+# writes the state handed to 'save' to 'path', which 'due' says is worth
+# doing once 'interval' seconds have passed since the last save
+class Checkpoint(object):
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.saved = time.time()
+
+    def due(self):
+        return (time.time() - self.saved) >= self.interval
+
+    def save(self, state):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix='.checkpoint-')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.saved = time.time()
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
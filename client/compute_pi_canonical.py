@@ -4,6 +4,12 @@
 #
 # This code uses Dispy on OctaPi in canonical form.
 #
+# Points are drawn in fixed size blocks with NumPy if it is installed,
+# otherwise a pure Python loop is used. The points can also be taken from
+# a randomised Sobol sequence (quasi-Monte Carlo), where the error falls
+# almost as 1/N rather than 1/sqrt(N); the spread of several randomised
+# replicates is then used to estimate the error.
+#
 # Reference: Arndt & Haenel, "Pi Uneashed", Springer-Verlag, 
 # ISBN 978-3-540-66572-4, 2006, 
 # English translation Catriona and David Lischka, pp. 39-41
@@ -16,25 +22,137 @@
 
 
 # 'compute' is distributed to each node running 'dispynode'
-def compute(s, n):
-    import time, random
-
+def compute(key, s, n, offset=0, block_size=1048576):
     inside = 0
 
-    # set the random seed on the server from that passed by the client
-    random.seed(s)
-
-    # for all the points requested
-    for i in range(n):
-        # compute position of the point
-        x = random.uniform(0.0, 1.0)
-        y = random.uniform(0.0, 1.0)
-        z = x*x + y*y
-        if (z<=1.0):
-            inside = inside + 1    # this point is inside the unit circle
+    try:
+        import numpy
+        from numpy.random import Generator, Philox
+    except ImportError:
+        numpy = None    # node has no NumPy (1.17 or later), use the pure Python loop below
+
+    if numpy is not None:
+        # each job has its own stream 's' of the counter based Philox
+        # generator keyed with the run key; the counter is positioned at
+        # point 'offset' so that a job can be split or resumed anywhere
+        rng = Generator(Philox(key=key, counter=(s << 128) + offset // 2))
+        if (offset % 2):
+            rng.random(2)    # each counter value covers two points, skip the first
+
+        # draw the points in blocks so that memory use is capped at
+        # roughly 24 bytes per point in a block, whatever the value of n;
+        # x and y are interleaved so the result does not depend on block size
+        remaining = n
+        while remaining > 0:
+            size = min(block_size, remaining)
+            xy = rng.random(2 * size)
+            xy *= xy                # work in place to avoid temporary arrays
+            z = xy[0::2] + xy[1::2]
+            inside += int(numpy.count_nonzero(z <= 1.0))    # points inside the unit circle
+            remaining -= size
+    else:
+        import random
+
+        # the same idea in pure Python: the stream is cut into chunks of
+        # 4096 points and each chunk has its own generator seeded from
+        # (run key, stream, chunk), so any point can be reached directly
+        chunk = 4096
+        position = offset
+        end = offset + n
+        while position < end:
+            c = position // chunk
+            uniform = random.Random('%x:%x:%x' % (key, s, c)).random
+            for j in range(2 * (position - c * chunk)):
+                uniform()    # skip the points before 'offset' in this chunk
+            count = min(end, (c + 1) * chunk) - position
+
+            # for all the points requested in this chunk
+            for i in range(count):
+                # compute position of the point
+                x = uniform()
+                y = uniform()
+                if (x*x + y*y <= 1.0):
+                    inside += 1    # this point is inside the unit circle
+            position += count
 
     return(s, inside)
 
+# 'compute_qmc' is distributed to each node running 'dispynode' when
+# Sobol sampling is selected. Each job takes a disjoint segment of the
+# sequence starting at index 'first', and 'shifts' holds one random
+# digital shift per replicate so that the client can estimate the error.
+def compute_qmc(first, n, shifts, block_size=1048576):
+    bits = 53    # each coordinate is a 53 bit binary fraction, exact as a double
+    scale = 1.0 / (1 << bits)
+
+    # Sobol direction numbers for the two coordinates, the first is the
+    # van der Corput sequence and the second uses the polynomial x + 1
+    v1 = [1 << (bits - 1 - k) for k in range(bits)]
+    v2 = [1 << (bits - 1)]
+    for k in range(1, bits):
+        v2.append(v2[-1] ^ (v2[-1] >> 1))
+
+    inside = [0] * len(shifts)
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None    # node has no NumPy, use the pure Python loop below
+
+    if numpy is not None:
+        done = 0
+        while done < n:
+            size = min(block_size, n - done)
+            index = numpy.arange(first + done, first + done + size, dtype=numpy.uint64)
+            index ^= index >> numpy.uint64(1)    # points are taken in Gray code order
+
+            # build the points directly from the bits of their index
+            x = numpy.zeros(size, dtype=numpy.uint64)
+            y = numpy.zeros(size, dtype=numpy.uint64)
+            for k in range((first + done + size - 1).bit_length()):
+                bit = (index >> numpy.uint64(k)) & numpy.uint64(1)
+                x ^= bit * numpy.uint64(v1[k])
+                y ^= bit * numpy.uint64(v2[k])
+
+            # the same points are reused by every replicate with its own shift
+            for r, (s1, s2) in enumerate(shifts):
+                u = (x ^ numpy.uint64(s1)).astype(numpy.float64) * scale
+                w = (y ^ numpy.uint64(s2)).astype(numpy.float64) * scale
+                u *= u
+                w *= w
+                u += w
+                inside[r] += int(numpy.count_nonzero(u <= 1.0))
+            done += size
+    else:
+        # compute the first point of the segment directly
+        index = first
+        gray = index ^ (index >> 1)
+        x = y = 0
+        k = 0
+        while gray:
+            if gray & 1:
+                x ^= v1[k]
+                y ^= v2[k]
+            gray >>= 1
+            k += 1
+
+        # for all the points requested
+        for i in range(n):
+            for r, (s1, s2) in enumerate(shifts):
+                u = (x ^ s1) * scale
+                w = (y ^ s2) * scale
+                if (u*u + w*w <= 1.0):
+                    inside[r] += 1    # this point is inside the unit circle
+
+            # moving one step in Gray code order flips a single index bit
+            index += 1
+            k = (index & -index).bit_length() - 1
+            if k < bits:
+                x ^= v1[k]
+                y ^= v2[k]
+
+    return(first, inside)
+
 # main 
 if __name__ == '__main__':
     import dispy, random, argparse, resource
@@ -45,34 +163,72 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("no_of_points", type=int, help="number of random points to include in each job")
     parser.add_argument("no_of_jobs", type =int, help="number of jobs to run")
+    parser.add_argument("--block-size", type=int, default=1048576, help="points drawn per NumPy block, caps memory used by each job")
+    parser.add_argument("--run-key", type=lambda v: int(v, 16), default=None, help="128 bit hex key to repeat an earlier run, random if not given")
+    parser.add_argument("--sampling", choices=["random", "sobol"], default="random", help="pseudo-random points or a randomised Sobol sequence")
+    parser.add_argument("--replicates", type=int, default=8, help="number of randomised Sobol replicates used to estimate the error")
     args = parser.parse_args()
 
     no_of_points = args.no_of_points
     no_of_jobs = args.no_of_jobs
+    block_size = args.block_size
+    sampling = args.sampling
+    replicates = args.replicates
+
+    # every job draws from its own stream of a generator keyed with the
+    # run key, so the whole run can be repeated by passing the same key
+    run_key = args.run_key
+    if run_key is None:
+        run_key = random.getrandbits(128)
+    print(('run key is %032x' % run_key))
     server_nodes ='192.168.1.*'
 
-    cluster = dispy.JobCluster(compute, nodes=server_nodes)
+    if (sampling == 'sobol'):
+        # one random digital shift per replicate, shared by every job
+        key_rng = random.Random(run_key)
+        shifts = [(key_rng.getrandbits(53), key_rng.getrandbits(53)) for r in range(replicates)]
+        cluster = dispy.JobCluster(compute_qmc, nodes=server_nodes)
+        print(('Sobol sampling selected with %i replicates' % replicates))
+    else:
+        cluster = dispy.JobCluster(compute, nodes=server_nodes)
     print(('submitting %i jobs of %i points each to %s' % (no_of_jobs, no_of_points, server_nodes)))
     jobs = []
     for i in range(no_of_jobs):
         # schedule execution of 'compute' on a node (running 'dispynode')
-        ran_seed = random.randint(0,65535) # define a random seed for each server using the client RNG
-        job = cluster.submit(ran_seed, no_of_points)
+        if (sampling == 'sobol'):
+            job = cluster.submit(i * no_of_points, no_of_points, shifts, block_size) # the job id selects the segment of the sequence
+        else:
+            job = cluster.submit(run_key, i, no_of_points, 0, block_size) # the job id selects the stream
         job.id = i # associate an ID to the job
         jobs.append(job)
 
     total_inside = 0
+    replicate_inside = [0] * replicates
     for job in jobs:
-        ran_seed, inside = job() # waits for job to finish and returns results
+        stream, inside = job() # waits for job to finish and returns results
 
+        if (sampling == 'sobol'):
+            # keep a separate count for each replicate
+            for r in range(replicates):
+                replicate_inside[r] += inside[r]
+            inside = sum(inside) // replicates
         total_inside += inside
 
         if (job.id % 1000 == 0):
-            print(('executed job %s using %i with result %i' % (job.id, ran_seed, inside)))
+            print(('executed job %s using stream %i with result %i' % (job.id, stream, inside)))
 
     # calclate the estimated value of Pi
     total_no_of_points = no_of_points * no_of_jobs
-    Pi = (4.0 * total_inside) / total_no_of_points
-    print(('value of Pi is estimated to be %f using %i points' % (Pi, total_no_of_points) ))
+    if (sampling == 'sobol'):
+        # each replicate is an independent unbiased estimate, so their
+        # spread gives the standard error of the mean
+        estimates = [(4.0 * r) / total_no_of_points for r in replicate_inside]
+        Pi = sum(estimates) / replicates
+        variance = sum([(e - Pi) ** 2 for e in estimates]) / max(replicates - 1, 1)
+        error = (variance / replicates) ** 0.5
+        print(('value of Pi is estimated to be %.12f +/- %.2e using %i points in %i replicates' % (Pi, error, total_no_of_points, replicates) ))
+    else:
+        Pi = (4.0 * total_inside) / total_no_of_points
+        print(('value of Pi is estimated to be %f using %i points' % (Pi, total_no_of_points) ))
 
     cluster.print_status()
@@ -5,6 +5,15 @@
 # This code uses Dispy on OctaPi using the recommended method for managing
 # jobs efficiently. For more information, visit the Dispy website. 
 #
+# Points are drawn in fixed size blocks with NumPy if it is installed,
+# otherwise a pure Python loop is used. The points can also be taken from
+# a randomised Sobol sequence (quasi-Monte Carlo), where the error falls
+# almost as 1/N rather than 1/sqrt(N); the spread of several randomised
+# replicates is then used to estimate the error.
+#
+# With --target-error, jobs are only submitted until the confidence
+# interval of the estimate is tight enough, then the rest are cancelled.
+#
 # Reference: Arndt & Haenel, "Pi Uneashed", Springer-Verlag, 
 # ISBN 978-3-540-66572-4, 2006, 
 # English translation Catriona and David Lischka, pp. 39-41
@@ -16,29 +25,175 @@
 # All other original code: Crown Copyright 2016, 2017 
 
 # 'compute' is distributed to each node running 'dispynode'
-def compute(s, n):
-    import time, random
-
+def compute(key, s, n, offset=0, block_size=1048576):
     inside = 0
 
-    # set the random seed on the server from that passed by the client
-    random.seed(s)
+    try:
+        import numpy
+        from numpy.random import Generator, Philox
+    except ImportError:
+        numpy = None    # node has no NumPy (1.17 or later), use the pure Python loop below
+
+    if numpy is not None:
+        # each job has its own stream 's' of the counter based Philox
+        # generator keyed with the run key; the counter is positioned at
+        # point 'offset' so that a job can be split or resumed anywhere
+        rng = Generator(Philox(key=key, counter=(s << 128) + offset // 2))
+        if (offset % 2):
+            rng.random(2)    # each counter value covers two points, skip the first
 
-    # for all the points requested
-    for i in range(n):
-        # compute position of the point
-        x = random.uniform(0.0, 1.0)
-        y = random.uniform(0.0, 1.0)
-        z = x*x + y*y
-        if (z<=1.0):
-            inside = inside + 1    # this point is inside the unit circle
+        # draw the points in blocks so that memory use is capped at
+        # roughly 24 bytes per point in a block, whatever the value of n;
+        # x and y are interleaved so the result does not depend on block size
+        remaining = n
+        while remaining > 0:
+            size = min(block_size, remaining)
+            xy = rng.random(2 * size)
+            xy *= xy                # work in place to avoid temporary arrays
+            z = xy[0::2] + xy[1::2]
+            inside += int(numpy.count_nonzero(z <= 1.0))    # points inside the unit circle
+            remaining -= size
+    else:
+        import random
+
+        # the same idea in pure Python: the stream is cut into chunks of
+        # 4096 points and each chunk has its own generator seeded from
+        # (run key, stream, chunk), so any point can be reached directly
+        chunk = 4096
+        position = offset
+        end = offset + n
+        while position < end:
+            c = position // chunk
+            uniform = random.Random('%x:%x:%x' % (key, s, c)).random
+            for j in range(2 * (position - c * chunk)):
+                uniform()    # skip the points before 'offset' in this chunk
+            count = min(end, (c + 1) * chunk) - position
+
+            # for all the points requested in this chunk
+            for i in range(count):
+                # compute position of the point
+                x = uniform()
+                y = uniform()
+                if (x*x + y*y <= 1.0):
+                    inside += 1    # this point is inside the unit circle
+            position += count
 
     return(s, inside)
 
+# 'compute_qmc' is distributed to each node running 'dispynode' when
+# Sobol sampling is selected. Each job takes a disjoint segment of the
+# sequence starting at index 'first', and 'shifts' holds one random
+# digital shift per replicate so that the client can estimate the error.
+def compute_qmc(first, n, shifts, block_size=1048576):
+    bits = 53    # each coordinate is a 53 bit binary fraction, exact as a double
+    scale = 1.0 / (1 << bits)
+
+    # Sobol direction numbers for the two coordinates, the first is the
+    # van der Corput sequence and the second uses the polynomial x + 1
+    v1 = [1 << (bits - 1 - k) for k in range(bits)]
+    v2 = [1 << (bits - 1)]
+    for k in range(1, bits):
+        v2.append(v2[-1] ^ (v2[-1] >> 1))
+
+    inside = [0] * len(shifts)
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None    # node has no NumPy, use the pure Python loop below
+
+    if numpy is not None:
+        done = 0
+        while done < n:
+            size = min(block_size, n - done)
+            index = numpy.arange(first + done, first + done + size, dtype=numpy.uint64)
+            index ^= index >> numpy.uint64(1)    # points are taken in Gray code order
+
+            # build the points directly from the bits of their index
+            x = numpy.zeros(size, dtype=numpy.uint64)
+            y = numpy.zeros(size, dtype=numpy.uint64)
+            for k in range((first + done + size - 1).bit_length()):
+                bit = (index >> numpy.uint64(k)) & numpy.uint64(1)
+                x ^= bit * numpy.uint64(v1[k])
+                y ^= bit * numpy.uint64(v2[k])
+
+            # the same points are reused by every replicate with its own shift
+            for r, (s1, s2) in enumerate(shifts):
+                u = (x ^ numpy.uint64(s1)).astype(numpy.float64) * scale
+                w = (y ^ numpy.uint64(s2)).astype(numpy.float64) * scale
+                u *= u
+                w *= w
+                u += w
+                inside[r] += int(numpy.count_nonzero(u <= 1.0))
+            done += size
+    else:
+        # compute the first point of the segment directly
+        index = first
+        gray = index ^ (index >> 1)
+        x = y = 0
+        k = 0
+        while gray:
+            if gray & 1:
+                x ^= v1[k]
+                y ^= v2[k]
+            gray >>= 1
+            k += 1
+
+        # for all the points requested
+        for i in range(n):
+            for r, (s1, s2) in enumerate(shifts):
+                u = (x ^ s1) * scale
+                w = (y ^ s2) * scale
+                if (u*u + w*w <= 1.0):
+                    inside[r] += 1    # this point is inside the unit circle
+
+            # moving one step in Gray code order flips a single index bit
+            index += 1
+            k = (index & -index).bit_length() - 1
+            if k < bits:
+                x ^= v1[k]
+                y ^= v2[k]
+
+    return(first, inside)
+
+# estimate Pi and the half width of its confidence interval from the
+# jobs finished so far, executed at the client
+def estimate_pi():
+    if (points_done == 0):
+        return (0.0, float('inf'))
+
+    if (sampling == 'sobol'):
+        # each replicate is an independent unbiased estimate, so their
+        # spread gives the standard error of the mean
+        estimates = [(4.0 * r) / points_done for r in replicate_inside]
+        Pi = sum(estimates) / replicates
+        variance = sum([(e - Pi) ** 2 for e in estimates]) / max(replicates - 1, 1)
+        error = (variance / replicates) ** 0.5
+    else:
+        # each point lands inside the quarter circle with probability Pi/4,
+        # so the number inside follows a binomial distribution
+        p = total_inside / points_done
+        Pi = 4.0 * p
+        error = 4.0 * (p * (1.0 - p) / points_done) ** 0.5
+
+    return (Pi, z_score * error)
+
+# the first 'tune_jobs' jobs are timed, and later jobs sized from them to
+# take about 'target_duration' seconds (see job_tuning.py); executed at
+# the client with 'jobs_cond' held
+def tune_granularity(job, size):
+    global granularity, tune_overhead, tune_cost
+
+    if (len(tune_samples) >= tune_jobs) or (job.start_time is None) or (job.end_time is None):
+        return
+    tune_samples.append((size, max(job.end_time - job.start_time, 1e-6)))
+    tune_overhead, tune_cost = job_tuning.fit_job_time(tune_samples)
+    granularity = job_tuning.target_size(size, tune_overhead, tune_cost, target_duration)
+
 # dispy calls this function to indicate change in job status
 def job_callback(job): # executed at the client
     global pending_jobs, jobs_cond
-    global total_inside
+    global total_inside, replicate_inside, points_done, done
 
     if (job.status == dispy.DispyJob.Finished  # most usual case
         or job.status in (dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled,
@@ -48,20 +203,39 @@ def job_callback(job): # executed at the client
         jobs_cond.acquire()
         if job.id: # job may have finished before 'main' assigned id
             pending_jobs.pop(job.id)
+            size = job_sizes.pop(job.id)
             if (job.id % 1000 == 0):
                 dispy.logger.info('job "%s" returned %s, %s jobs pending', job.id, job.result, len(pending_jobs))
 
-            # extract the results for each job as it happens
-            ran_seed, inside = job.result # returns results from job
-            total_inside += inside        # count the num of points inside quarter circle
+            # only finished jobs have results, cancelled ones are simply dropped
+            if (job.status == dispy.DispyJob.Finished):
+                # extract the results for each job as it happens
+                stream, inside = job.result # returns results from job
+                if (sampling == 'sobol'):
+                    # keep a separate count for each replicate
+                    for r in range(replicates):
+                        replicate_inside[r] += inside[r]
+                    inside = sum(inside) // replicates
+                total_inside += inside        # count the num of points inside quarter circle
+                points_done += size
+                if auto_tune:
+                    tune_granularity(job, size)
+
+                # stop once the confidence interval is tight enough
+                if target_error and not done:
+                    Pi, error = estimate_pi()
+                    if (error <= target_error):
+                        done = True
+                        dispy.logger.info('target error reached: %.10f +/- %.2e using %i points', Pi, error, points_done)
 
-            if len(pending_jobs) <= lower_bound:
+            if len(pending_jobs) <= lower_bound or done:
                 jobs_cond.notify()
         jobs_cond.release()
 
 # main 
 if __name__ == '__main__':
-    import dispy, random, argparse, resource, threading, logging, decimal, socket
+    import dispy, random, argparse, resource, threading, logging, socket, statistics
+    import job_tuning
 
     # set lower and upper bounds as appropriate
     # lower_bound is at least num of cpus and upper_bound is roughly 3x lower_bound
@@ -72,35 +246,86 @@ if __name__ == '__main__':
     resource.setrlimit(resource.RLIMIT_DATA, (resource.RLIM_INFINITY, resource.RLIM_INFINITY) )
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("no_of_points", type=int, help="number of random points to include in each job")
-    parser.add_argument("no_of_jobs", type =int, help="number of jobs to run")
+    parser.add_argument("no_of_points", type=int, help="number of random points to include in each job (the first jobs with --auto-tune)")
+    parser.add_argument("no_of_jobs", type =int, help="number of jobs to run (the maximum if --target-error is given)")
+    parser.add_argument("--block-size", type=int, default=1048576, help="points drawn per NumPy block, caps memory used by each job")
+    parser.add_argument("--run-key", type=lambda v: int(v, 16), default=None, help="128 bit hex key to repeat an earlier run, random if not given")
+    parser.add_argument("--sampling", choices=["random", "sobol"], default="random", help="pseudo-random points or a randomised Sobol sequence")
+    parser.add_argument("--replicates", type=int, default=8, help="number of randomised Sobol replicates used to estimate the error")
+    parser.add_argument("--target-error", type=float, default=None, help="stop once the confidence interval is within +/- this value")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the reported interval")
+    parser.add_argument("--auto-tune", action="store_true", help="resize jobs to take about --target-duration seconds each, keeping the total number of points")
+    parser.add_argument("--target-duration", type=float, default=3.0, help="job duration in seconds aimed for by --auto-tune")
     args = parser.parse_args()
 
     no_of_points = args.no_of_points
     no_of_jobs = args.no_of_jobs
+    block_size = args.block_size
+    sampling = args.sampling
+    replicates = args.replicates
+    target_error = args.target_error
+    confidence = args.confidence
+    auto_tune = args.auto_tune
+    target_duration = args.target_duration
     server_nodes ='192.168.1.*'
 
+    # every job draws from its own stream of a generator keyed with the
+    # run key, so the whole run can be repeated by passing the same key
+    run_key = args.run_key
+    if run_key is None:
+        run_key = random.getrandbits(128)
+    print(('run key is %032x' % run_key))
+
+    # number of standard errors either side of the estimate for the interval
+    z_score = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+
     # use Condition variable to protect access to pending_jobs, as
     # 'job_callback' is executed in another thread
     jobs_cond = threading.Condition()
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(("8.8.8.8", 80)) # doesn't matter if 8.8.8.8 can't be reached
-    cluster = dispy.JobCluster(compute, nodes=server_nodes, callback=job_callback, ip_addr=s.getsockname()[0], loglevel=logging.INFO)
+    if (sampling == 'sobol'):
+        # one random digital shift per replicate, shared by every job
+        key_rng = random.Random(run_key)
+        shifts = [(key_rng.getrandbits(53), key_rng.getrandbits(53)) for r in range(replicates)]
+        cluster = dispy.JobCluster(compute_qmc, nodes=server_nodes, callback=job_callback, ip_addr=s.getsockname()[0], loglevel=logging.INFO)
+        print(('Sobol sampling selected with %i replicates' % replicates))
+    else:
+        cluster = dispy.JobCluster(compute, nodes=server_nodes, callback=job_callback, ip_addr=s.getsockname()[0], loglevel=logging.INFO)
     pending_jobs = {}
 
     print(('submitting %i jobs of %i points each to %s' % (no_of_jobs, no_of_points, server_nodes)))
     total_inside = 0
+    replicate_inside = [0] * replicates
+    points_done = 0
+    done = False
+
+    # the job size starts at no_of_points, and the tuner (if enabled) moves
+    # it while the first jobs finish; the total number of points is fixed
+    granularity = no_of_points
+    tune_jobs = 4 * upper_bound
+    tune_samples = []
+    tune_overhead, tune_cost = 0.0, 0.0
+    job_sizes = {}
+    total_no_of_points = no_of_points * no_of_jobs
+    points_submitted = 0
+
     i = 0
-    while i <= no_of_jobs:
+    while (points_submitted < total_no_of_points) and (done == False):
         i += 1
+        size = min(granularity, total_no_of_points - points_submitted)
 
         # schedule execution of 'compute' on a node (running 'dispynode')
-        ran_seed = random.randint(0,65535) # define a random seed for each server using the client RNG
-        job = cluster.submit(ran_seed, no_of_points)
+        if (sampling == 'sobol'):
+            job = cluster.submit(points_submitted, size, shifts, block_size) # the next segment of the sequence
+        else:
+            job = cluster.submit(run_key, i - 1, size, 0, block_size) # the job id selects the stream
+        points_submitted += size
 
         jobs_cond.acquire()
 
         job.id = i # associate an ID to the job
+        job_sizes[i] = size
 
         # there is a chance the job may have finished and job_callback called by
         # this time, so put it in 'pending_jobs' only if job is pending
@@ -108,17 +333,28 @@ if __name__ == '__main__':
             pending_jobs[i] = job
             # dispy.logger.info('job "%s" submitted: %s', i, len(pending_jobs))
             if len(pending_jobs) >= upper_bound:
-                while len(pending_jobs) > lower_bound:
+                while len(pending_jobs) > lower_bound and (done == False):
                     jobs_cond.wait()
         jobs_cond.release()
 
+    if (done == True):
+        # the estimate is already good enough, so don't waste cluster time
+        # on the jobs still queued or running
+        jobs_cond.acquire()
+        unfinished = list(pending_jobs.values())
+        jobs_cond.release()
+        for job in unfinished:
+            cluster.cancel(job)
+        print(('stopped after submitting %i of %i points, cancelled %i jobs' % (points_submitted, total_no_of_points, len(unfinished))))
+
     cluster.wait()
 
-    # calclate the estimated value of Pi
-    total_no_of_points = no_of_points * no_of_jobs
-    decimal.getcontext().prec = 100  # override standard precision
-    Pi = decimal.Decimal(4 * total_inside / total_no_of_points)
-    print(('value of Pi is estimated to be %s using %i points' % (Pi, total_no_of_points) ))
+    # calclate the estimated value of Pi with its confidence interval
+    Pi, error = estimate_pi()
+    print(('value of Pi is estimated to be %.10f +/- %.2e using %i points' % (Pi, error, points_done) ))
+    print(('%g%% confidence interval is %.10f - %.10f' % (100 * confidence, Pi - error, Pi + error) ))
+    if auto_tune:
+        print(('job granularity tuned to %i points per job from %i samples (overhead %.3f sec, %.3e sec per point)' % (granularity, len(tune_samples), tune_overhead, tune_cost) ))
 
     cluster.print_status()
     cluster.close()
@@ -3,6 +3,15 @@
 # This code uses Dispy on OctaPi using the recommended method for managing
 # jobs efficiently. For more information, visit the Dispy website. 
 #
+# The default method searches chunks of candidates below the square root,
+# in the order given by --order (see search_plan.py). With --method rho
+# every job is an independent Pollard rho walk instead, with --method
+# fermat every job checks a range of a for a^2 - semi-prime being a
+# square, and with --method ecm every job runs a batch of elliptic curves.
+# With --method siqs the jobs sieve quadratic sieve polynomials and return
+# relations, which the client combines into a factor. The jobs still
+# pending are cancelled once a factor is found.
+#
 
 # Dispy:
 # Giridhar Pemmasani, "dispy: Distributed and parallel Computing with/for Python",
@@ -23,133 +32,838 @@
 
 
 def find_factor(semi_prime, lower, upper):
+    # GMP probable prime tests where installed, chosen once for the job
+    try:
+        import gmpy2
+    except ImportError:
+        gmpy2 = None
 
-    def naivePrimalityTest(number):
+    # deterministic primality test: Miller-Rabin with fixed witness sets
+    # that are proven exact below 3.3e24, and Baillie-PSW (a strong base 2
+    # test plus a strong Lucas test) above that
+    def DeterministicPrimalityTest(number):
         import math
 
-        if number == 2:
-           return true
-        if number % 2 == 0:
+        # strong probable prime test of 'number' to base 'a', where
+        # number - 1 = oddPartOfNumber * 2^timesTwoDividNumber
+        def strongProbablePrime(a, oddPartOfNumber, timesTwoDividNumber):
+            if (gmpy2 is not None) and (a > 1):
+                return gmpy2.is_strong_prp(number, a)
+            x = pow(a, oddPartOfNumber, number)
+            if (x == 1) or (x == number - 1):
+                return True
+            for iterationNumber in range(timesTwoDividNumber - 1):
+                x = x * x % number
+                if (x == number - 1):
+                    return True
             return False
-    
-        i = 3
-        sqrtOfNumber = math.sqrt(number)
-    
-        while i <= sqrtOfNumber:
-            if number % i == 0:
+
+        # Jacobi symbol (a/n) for odd n > 0
+        def jacobi(a, n):
+            a = a % n
+            result = 1
+            while a != 0:
+                while a % 2 == 0:
+                    a = a // 2
+                    if n % 8 in (3, 5):
+                        result = -result
+                a, n = n, a
+                if (a % 4 == 3) and (n % 4 == 3):
+                    result = -result
+                a = a % n
+            return result if n == 1 else 0
+
+        # strong Lucas probable prime test with Selfridge's parameters
+        def strongLucasProbablePrime():
+            # a square has no suitable D, and is not prime anyway
+            if math.isqrt(number) ** 2 == number:
                 return False
-            i = i+2
-        
-        return True
 
-    def FermatPrimalityTest(number):
-        import random, math
-
-        # if number != 1
-        if (number > 1):
-            # repeat the test few times
-            for time in range(3):
-                # Draw a RANDOM number in range of number ( Z_number )
-                randomNumber = random.randint(2, number)-1
-            
-                # Test if a^(n-1) = 1 mod n
-                if ( pow(randomNumber, number-1, number) != 1 ):
-                    return False
-        
-            return True
-        else:
-            # case number == 1
+            if (gmpy2 is not None):
+                return gmpy2.is_strong_selfridge_prp(number)
+
+            # first D in 5, -7, 9, -11, ... with (D/number) = -1
+            D = 5
+            while True:
+                j = jacobi(D, number)
+                if (j == -1):
+                    break
+                if (j == 0) and (abs(D) != number):
+                    return False    # D shares a factor with number
+                D = -D - 2 if D > 0 else -D + 2
+            P, Q = 1, (1 - D) // 4
+
+            # number + 1 = d * 2^s with d odd
+            d, s = number + 1, 0
+            while d % 2 == 0:
+                d, s = d // 2, s + 1
+
+            # U_d and V_d by the binary method, halving modulo an odd number
+            def half(x):
+                x = x % number
+                return (x + number) // 2 if x % 2 else x // 2
+
+            U, V, Qk = 1, P, Q % number
+            for bit in bin(d)[3:]:
+                U, V = U * V % number, (V * V - 2 * Qk) % number
+                Qk = Qk * Qk % number
+                if bit == '1':
+                    U, V = half(P * U + V), half(D * U + P * V)
+                    Qk = Qk * Q % number
+
+            if (U == 0) or (V == 0):
+                return True
+            for r in range(s - 1):
+                V = (V * V - 2 * Qk) % number
+                Qk = Qk * Qk % number
+                if (V == 0):
+                    return True
             return False
 
-    def MillerRabinPrimalityTest(number):
-        import random, math
-    
-        # because the algorithm input is ODD number than if we get
-        # even and it is the number 2 we return TRUE ( spcial case )
-        # if we get the number 1 we return false and any other even 
-        # number we will return false.
-    
-        if number == 2:
-            return True
-        elif number == 1 or number % 2 == 0:
+        if number < 2:
             return False
-    
-        # first we want to express n as : 2^s * r ( were r is odd )
-    
-        # the odd part of the number
+        # trial divide by the small primes, which are also the witnesses below
+        for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41):
+            if number % p == 0:
+                return number == p
+
+        # express number - 1 as 2^s * r ( were r is odd ), exactly
         oddPartOfNumber = number - 1
-    
-        # The number of time that the number is divided by two
-        timesTwoDividNumber = 0
-    
-        # while r is even divid by 2 to find the odd part
-        while oddPartOfNumber % 2 == 0:
-            oddPartOfNumber = oddPartOfNumber // 2
-            timesTwoDividNumber = timesTwoDividNumber + 1 
-     
-    
-        # since there are number that are cases of "strong liar" we 
-        # need to check more then one number
-    
-        for time in range(3):
-        
-            # choose "Good" random number
-            while True:
-                # Draw a RANDOM number in range of number ( Z_number )
-                randomNumber = random.randint(2, number)-1
-                if randomNumber != 0 and randomNumber != 1:
-                    break
-        
-            # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-            randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
-        
-            # if random number is not 1 and not -1 ( in mod n ) 
-            if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
-                # number of iteration
-                iterationNumber = 1
-            
-                # while we can squre the number and the squered number is not -1 mod number
-                while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
-                    # squre the number
-                    randomNumberWithPower = pow(randomNumberWithPower, 2, number)
-                
-                    # inc the number of iteration
-                    iterationNumber = iterationNumber + 1
-                
-                # if x != -1 mod number then it because we did not found strong witnesses
-                # hence 1 have more then two roots in mod n ==>
-                # n is composite ==> return false for primality
-            
-                if (randomNumberWithPower != (number - 1)):
-                    return False
-            
-        # well the number pass the tests ==> it is probably prime ==> return true for primality
-        return True 
-
-
-    # search between the lower and upper limits
-    while (lower <= upper):
-        factor1 = lower
-        # only test prime numbers
-        if MillerRabinPrimalityTest(factor1) and FermatPrimalityTest(factor1):
-            if (semi_prime % factor1 == 0):
+        timesTwoDividNumber = (oddPartOfNumber & -oddPartOfNumber).bit_length() - 1
+        oddPartOfNumber = oddPartOfNumber >> timesTwoDividNumber
+
+        # these witness sets are proven to have no strong liars below the
+        # limit, so the answer is exact rather than probable
+        if number < 2047:
+            witnesses = (2,)
+        elif number < 1373653:
+            witnesses = (2, 3)
+        elif number < 25326001:
+            witnesses = (2, 3, 5)
+        elif number < 3215031751:
+            witnesses = (2, 3, 5, 7)
+        elif number < 2152302898747:
+            witnesses = (2, 3, 5, 7, 11)
+        elif number < 3474749660383:
+            witnesses = (2, 3, 5, 7, 11, 13)
+        elif number < 341550071728321:
+            witnesses = (2, 3, 5, 7, 11, 13, 17)
+        elif number < 18446744073709551616:    # 2^64
+            witnesses = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+        elif number < 3317044064679887385961981:
+            witnesses = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+        else:
+            # Baillie-PSW: no composite is known to pass both of these
+            return strongProbablePrime(2, oddPartOfNumber, timesTwoDividNumber) and strongLucasProbablePrime()
+
+        for a in witnesses:
+            if (a % number != 0) and not strongProbablePrime(a % number, oddPartOfNumber, timesTwoDividNumber):
+                return False
+        return True
+
+
+    # product of the primes from 17 up to 'limit', so that 'smallPrimeFilter'
+    # can screen a candidate against all of them with a single gcd
+    def smallPrimorial(limit=1000):
+        primorial = 1
+        for p in range(17, limit, 2):
+            if all(p % q for q in range(3, int(p ** 0.5) + 1, 2)):
+                primorial *= p
+        return primorial
+
+    # cheap screen in front of the modular exponentiation tests: trial division
+    # by the primes below 17, then one gcd against 'primorial'. Returns False
+    # if 'number' has a small factor, so is composite, and True if it still
+    # needs a full test. 'counts' keeps the totals screened, rejected by trial
+    # division, rejected by the gcd and passed on to the full test
+    def smallPrimeFilter(number, primorial, counts):
+        import math
+
+        counts[0] += 1
+        if number < 1000:    # may be one of the small primes itself
+            counts[3] += 1
+            return True
+        for p in (2, 3, 5, 7, 11, 13):
+            if number % p == 0:
+                counts[1] += 1
+                return False
+        if math.gcd(number, primorial) != 1:
+            counts[2] += 1
+            return False
+        counts[3] += 1
+        return True
+
+
+    # gcd screen of a block of candidates: a product tree is built over
+    # them, kept mod semi_prime as only the gcd with it matters, and only
+    # the subtrees whose product shares a factor with semi_prime are
+    # searched; returns the candidates that do
+    def productTreeScreen(candidates):
+        import math
+
+        if not candidates:
+            return []
+        tree = [candidates]
+        while len(tree[-1]) > 1:
+            level = tree[-1]
+            products = [level[i] * level[i + 1] % semi_prime for i in range(0, len(level) - 1, 2)]
+            if (len(level) % 2):
+                products.append(level[-1])
+            tree.append(products)
+
+        hits = []
+        search = [(len(tree) - 1, 0)]    # (level, index) from the root down
+        while search:
+            depth, index = search.pop()
+            if math.gcd(tree[depth][index], semi_prime) == 1:
+                continue
+            if (depth == 0):
+                hits.append(tree[0][index])
+            else:
+                search += [(depth - 1, child) for child in (2 * index, 2 * index + 1) if child < len(tree[depth - 1])]
+        return sorted(hits)
+
+    import math
+
+    primorial = smallPrimorial()
+    counts = [0, 0, 0, 0, 0]
+
+    # the chunk is searched in blocks of 'block' odd numbers
+    block = 4096
+    while (lower <= upper) and not factor_found():
+        # the candidates in this block, after a cheap screen for small factors
+        candidates = []
+        last = min(upper, lower + 2 * (block - 1))
+        while (lower <= last):
+            if smallPrimeFilter(lower, primorial, counts):
+                candidates.append(lower)
+            lower = lower + 2    # skip even factors because they can't be prime
+
+        # one gcd rejects a block with no factor of semi_prime in it, so
+        # only the rare candidates that share a factor with it are tested
+        for candidate in productTreeScreen(candidates):
+            counts[4] += 1
+            factor1 = math.gcd(candidate, semi_prime)
+            if DeterministicPrimalityTest(factor1):
                 factor2 = semi_prime // factor1
-                
+
                 # try this prime to see if it is a factor
                 if (factor1 * factor2 == semi_prime):
-#                    print ('%i * %i = %i' % (factor1, factor2, factor1*factor2))
-                    return (factor1, factor2)
+                    return (factor1, factor2, tuple(counts))
+
+    # no factors found
+    return (0, 0, tuple(counts))
+
+
+# one Pollard rho walk, x -> x^2 + constant mod semi_prime from 'seed',
+# with Brent's cycle finding: the differences are multiplied together mod
+# semi_prime and a gcd is taken only once every 'batch' steps. Gives up
+# at the end of the first stretch that takes it past 'steps' steps;
+# returns the factors (0, 0 if none) and the number of steps walked
+def rho_factor(semi_prime, constant, seed, steps, batch):
+    import math
+    try:
+        import gmpy2    # GMP arithmetic, where installed
+        n, c, y = gmpy2.mpz(semi_prime), gmpy2.mpz(constant), gmpy2.mpz(seed)
+        gcd = gmpy2.gcd
+    except ImportError:
+        n, c, y = semi_prime, constant, seed
+        gcd = math.gcd
+
+    if (semi_prime % 2) == 0:
+        return (2, semi_prime // 2, 0)
+
+    g, q, r, walked = 1, 1, 1, 0
+    x = ys = y
+    while (g == 1) and (walked < steps):
+        # x stays at the start of this stretch while y runs r steps ahead
+        x = y
+        for k in range(0, r, 65536):
+            if factor_found():
+                return (0, 0, walked)
+            for i in range(min(65536, r - k)):
+                y = (y * y + c) % n
+            walked += min(65536, r - k)
+
+        k = 0
+        while (k < r) and (g == 1):
+            if ((k // batch) % 512 == 511) and factor_found():
+                return (0, 0, walked)
+            ys = y
+            for i in range(min(batch, r - k)):
+                y = (y * y + c) % n
+                q = q * abs(x - y) % n
+            g = gcd(q, n)
+            walked += min(batch, r - k)
+            k += batch
+        r *= 2
+
+    # the product took in the whole factor at once, so go back over the
+    # last batch one gcd at a time
+    if (g == n):
+        g = 1
+        while (g == 1):
+            ys = (ys * ys + c) % n
+            g = gcd(abs(x - ys), n)
+
+    # both walks met mod semi_prime itself, this walk is no use
+    if (g == 1) or (g == n):
+        return (0, 0, walked)
+    return (int(g), int(n // g), walked)
+
+
+# Lenstra's elliptic curve method, on one batch of curves: for each
+# 'sigma', Suyama's parametrisation gives a Montgomery curve and a point
+# on it, which is multiplied by every prime power up to B1 (stage 1),
+# then checked against each prime q in B1 .. B2 with baby steps j * Q
+# and giant steps m * D * Q, as q = m * D +/- j (stage 2). Only the x and
+# z coordinates are kept, so a factor shows up in gcd(Z, semi_prime).
+# Returns the factors (0, 0 if none) and the number of curves run
+def ecm_factor(semi_prime, sigmas, B1, B2):
+    import math
+    try:
+        import gmpy2    # GMP arithmetic, where installed
+        n = gmpy2.mpz(semi_prime)
+        gcd = gmpy2.gcd
+    except ImportError:
+        n = semi_prime
+        gcd = math.gcd
+
+    # D * Q is the giant step, with 1/2 * phi(D) baby steps
+    D = 2310 if B2 >= 100000 else 210
+
+    # primes up to B1 and the square root of B2, by a plain sieve
+    limit = max(B1, math.isqrt(B2 + D))
+    flags = bytearray(b'\x01') * (limit + 1)
+    flags[0:2] = b'\x00\x00'
+    for p in range(2, math.isqrt(limit) + 1):
+        if flags[p]:
+            flags[p * p::p] = bytes(len(range(p * p, limit + 1, p)))
+    base = [p for p in range(2, math.isqrt(B2 + D) + 1) if flags[p]]
+
+    # the primes in start .. start + count - 1, one flag per number, so
+    # that stage 2 never holds more than one segment of B1 .. B2
+    def segmentFlags(start, count):
+        segment = bytearray(b'\x01') * count
+        for p in base:
+            m = max(p * p, (start + p - 1) // p * p)
+            if (m - start) < count:
+                segment[m - start::p] = bytes(len(range(m - start, count, p)))
+        return segment
+
+    # x-only Montgomery curve arithmetic, a24 = (A + 2) / 4
+    def double(X, Z, a24):
+        t1 = (X + Z) * (X + Z) % n
+        t2 = (X - Z) * (X - Z) % n
+        t3 = t1 - t2
+        return t1 * t2 % n, t3 * (t2 + a24 * t3) % n
+
+    # P1 + P2, given their difference
+    def add(X1, Z1, X2, Z2, Xd, Zd):
+        t1 = (X1 - Z1) * (X2 + Z2)
+        t2 = (X1 + Z1) * (X2 - Z2)
+        return Zd * (t1 + t2) * (t1 + t2) % n, Xd * (t1 - t2) * (t1 - t2) % n
+
+    # k * P by the Montgomery ladder
+    def multiply(k, X, Z, a24):
+        X0, Z0 = X, Z
+        X1, Z1 = double(X, Z, a24)
+        for bit in bin(k)[3:]:
+            if bit == '1':
+                X0, Z0 = add(X1, Z1, X0, Z0, X, Z)
+                X1, Z1 = double(X1, Z1, a24)
+            else:
+                X1, Z1 = add(X0, Z0, X1, Z1, X, Z)
+                X0, Z0 = double(X0, Z0, a24)
+        return X0, Z0
+
+    curves = 0
+    for sigma in sigmas:
+        if factor_found():
+            break
+        curves += 1
 
-        lower = lower + 2    # skip even factors because they can't be prime
+        # Suyama's parametrisation
+        u = (sigma * sigma - 5) % n
+        v = 4 * sigma % n
+        X, Z = u * u * u % n, v * v * v % n
+        denominator = 16 * X * v % n
+        g = gcd(denominator, n)
+        if (g != 1):
+            if (g != n):
+                return (int(g), int(n // g), curves)
+            continue    # a degenerate curve
+        a24 = (v - u) * (v - u) * (v - u) * (3 * u + v) * pow(int(denominator), -1, semi_prime) % n
+
+        # stage 1: Q = (product of the prime powers up to B1) * P
+        for p in range(2, B1 + 1):
+            if flags[p]:
+                power = p
+                while (power * p <= B1):
+                    power *= p
+                X, Z = multiply(power, X, Z, a24)
+            if (p % 65536 == 0) and factor_found():
+                return (0, 0, curves)
+        g = gcd(Z, n)
+        if (g == n):
+            continue    # every factor at once, try the next curve
+        if (g != 1):
+            return (int(g), int(n // g), curves)
+
+        # stage 2, baby steps j * Q for the odd j < D / 2, kept for j prime to D
+        X2, Z2 = double(X, Z, a24)
+        odd = {1: (X, Z), 3: add(X2, Z2, X, Z, X, Z)}
+        for j in range(5, D // 2, 2):
+            odd[j] = add(odd[j - 2][0], odd[j - 2][1], X2, Z2, odd[j - 4][0], odd[j - 4][1])
+        baby = [(j, Xj, Zj) for j, (Xj, Zj) in odd.items() if math.gcd(j, D) == 1]
+
+        # giant steps m * D * Q, with the cross products multiplied
+        # together for every m * D +/- j that is a prime in range
+        m = max(B1 // D, 1)
+        SX, SZ = multiply(D, X, Z, a24)
+        RX, RZ = multiply(m * D, X, Z, a24)
+        NX, NZ = multiply((m + 1) * D, X, Z, a24)
+        product = 1
+        start, segment = 0, b''
+        while (m * D - D // 2) <= B2:
+            if (m * D + D // 2) >= (start + len(segment)):
+                if factor_found():
+                    return (0, 0, curves)
+                start = m * D - D // 2
+                segment = segmentFlags(start, 1024 * D)
+            for j, Xj, Zj in baby:
+                below, above = m * D - j, m * D + j
+                if (B1 < below and segment[below - start]) or (above <= B2 and segment[above - start]):
+                    product = product * (RX * Zj - Xj * RZ) % n
+            RX, RZ, NX, NZ = NX, NZ, *add(NX, NZ, SX, SZ, RX, RZ)
+            m += 1
+        g = gcd(product, n)
+        if (g != 1) and (g != n):
+            return (int(g), int(n // g), curves)
 
     # no factors found
+    return (0, 0, curves)
+
+
+# Fermat's method over a = lower .. upper: semi_prime = a^2 - b^2 =
+# (a - b) * (a + b), so look for an a where a^2 - semi_prime is a square,
+# which for balanced factors is found close to the square root. Values of
+# a where a^2 - semi_prime is not a square mod 16, 9, 5 and 7 are never
+# visited, the ones left are checked against a few more moduli, and only
+# the survivors pay for an isqrt. Returns the factors (0, 0 if none) and
+# the counts of values of a in the range, rejected by the residue sieves
+# and checked with isqrt
+def fermat_factor(semi_prime, lower, upper):
+    import math
+    try:
+        from gmpy2 import isqrt    # GMP arithmetic, where installed
+    except ImportError:
+        isqrt = math.isqrt
+
+    if (semi_prime % 2) == 0:
+        return (2, semi_prime // 2, (0, 0, 0))
+
+    # table[r] is True if r * r - semi_prime is a square mod m
+    def residueTable(m):
+        squares = set([x * x % m for x in range(m)])
+        return [((r * r - semi_prime) % m) in squares for r in range(m)]
+
+    # the offsets of a mod 'stride' that pass all of its moduli
+    stride = 16 * 9 * 5 * 7
+    passes = [residueTable(m) for m in (16, 9, 5, 7)]
+    offsets = [r for r in range(stride) if passes[0][r % 16] and passes[1][r % 9] and passes[2][r % 5] and passes[3][r % 7]]
+    tables = [(m, residueTable(m)) for m in (11, 13, 17, 19, 23, 29, 31, 37)]
+
+    checked = 0
+    for block in range(lower - lower % stride, upper + 1, stride):
+        if ((block // stride) % 64 == 0) and factor_found():
+            break
+        for offset in offsets:
+            a = block + offset
+            if (a < lower) or (a > upper):
+                continue
+            if all(table[a % m] for m, table in tables):
+                checked += 1
+                b2 = a * a - semi_prime
+                b = isqrt(b2)
+                if (b * b == b2) and (a - b > 1):
+                    return (int(a - b), int(a + b), (a - lower + 1, a - lower + 1 - checked, checked))
+
+    # no factors found
+    return (0, 0, (upper - lower + 1, upper - lower + 1 - checked, checked))
+
+
+# self-initialising quadratic sieve over the 2^(s-1) polynomials
+# (A x + B)^2 - semi_prime = A * (A x^2 + 2 B x + C) that share one
+# A = q_1 * ... * q_s, for x in -M .. M - 1. 'factor_base' is the list of
+# (p, sqrt(semi_prime) mod p) shared by every job, and 'a_indices' picks
+# the q's out of it. Moving from one B to the next only shifts the sieve
+# roots by a precomputed amount, which is what makes it self-initialising.
+# Values that factor over the factor base come back as relations
+# (A x + B mod semi_prime, factor base indices with repeats, -1 for the
+# sign), and values that do apart from one prime below
+# 'large_prime_bound' as partials with that prime added; also returns the
+# number of polynomials sieved
+def siqs_sieve(semi_prime, factor_base, a_indices, M, large_prime_bound):
+    import math
+    try:
+        import numpy    # sieve with array slices, where installed
+    except ImportError:
+        numpy = None
+
+    n = semi_prime
+    A = 1
+    for i in a_indices:
+        A *= factor_base[i][0]
+
+    # B = B_1 + ... + B_s, with B_l^2 = n mod q_l and B_l = 0 mod the other q's
+    Bl = []
+    for i in a_indices:
+        q, t = factor_base[i]
+        gamma = t * pow(A // q % q, -1, q) % q
+        if (gamma > q // 2):
+            gamma = q - gamma
+        Bl.append(A // q * gamma)
+    B = sum(Bl)
+
+    # the primes below 'small' are left out of the sieve, as they cost the
+    # most to sieve and add the least, and the threshold allows for them
+    small = 30
+    sieving = []    # [p, log p, root 1, root 2, shift for each B_l]
+    for index, (p, t) in enumerate(factor_base):
+        if (p < small) or (index in a_indices):
+            continue
+        ainv = pow(A % p, -1, p)
+        sieving.append([p, int(round(math.log2(p))), ainv * (t - B) % p, ainv * (-t - B) % p, [2 * b * ainv % p for b in Bl]])
+
+    # |A x^2 + 2 B x + C| stays below about M * sqrt(semi_prime / 2), and
+    # a value is worth trial division if the sieve found most of that
+    largest = factor_base[-1][0]
+    threshold = int(math.log2(M) + math.log2(n) / 2 - 0.5 - 2 * math.log2(largest) + 5)
+
+    relations, partials = [], []
+    polynomials = 1 << (len(a_indices) - 1)
+    for i in range(polynomials):
+        if factor_found():
+            break
+        if (i > 0):
+            # Gray code order: one B_l changes sign at each step
+            v = (i & -i).bit_length() - 1
+            e = -1 if ((i ^ (i >> 1)) >> v) & 1 else 1
+            B += 2 * e * Bl[v]
+            for entry in sieving:
+                p, delta = entry[0], entry[4][v]
+                entry[2] = (entry[2] - e * delta) % p
+                entry[3] = (entry[3] - e * delta) % p
+        C = (B * B - n) // A
+
+        if (numpy is not None):
+            sieve = numpy.zeros(2 * M, dtype=numpy.uint16)
+            for p, logp, r1, r2, deltas in sieving:
+                sieve[(r1 + M) % p::p] += logp
+                if (r1 != r2):
+                    sieve[(r2 + M) % p::p] += logp
+            candidates = numpy.flatnonzero(sieve >= threshold).tolist()
+        else:
+            sieve = [0] * (2 * M)
+            for p, logp, r1, r2, deltas in sieving:
+                for k in range((r1 + M) % p, 2 * M, p):
+                    sieve[k] += logp
+                if (r1 != r2):
+                    for k in range((r2 + M) % p, 2 * M, p):
+                        sieve[k] += logp
+            candidates = [k for k in range(2 * M) if sieve[k] >= threshold]
+
+        # trial division of the candidates over the whole factor base
+        for k in candidates:
+            x = k - M
+            value = (A * x + 2 * B) * x + C
+            if (value == 0):
+                continue
+            indices = list(a_indices)
+            if (value < 0):
+                indices.append(-1)
+                value = -value
+            for index, (p, t) in enumerate(factor_base):
+                while (value % p == 0):
+                    value //= p
+                    indices.append(index)
+            if (value == 1):
+                relations.append(((A * x + B) % n, tuple(indices)))
+            elif (value < large_prime_bound):
+                partials.append(((A * x + B) % n, tuple(indices), value))
+
+    return (relations, partials, polynomials)
+
+
+# search a chunk through the primes that the prime cache holds for it;
+# returns the same as 'find_factor', or None if the cache cannot cover
+# the chunk; executed at the client
+def cached_factor(cache, semi_prime, lower, upper):
+    primes = cache.primes_in_range(lower, upper)
+    if primes is None:
+        return None
+    for factor1 in primes:
+        if (semi_prime % factor1 == 0):
+            return (factor1, semi_prime // factor1, (0, 0, 0, 0, 0))
+    return (0, 0, (0, 0, 0, 0, 0))
+
+
+# stage 1 and stage 2 bounds, and the number of curves expected to find
+# a factor of up to 'digits' digits, from the table of optimal parameters
+# published with GMP-ECM; its stage 2 goes much further than the one
+# here, so the curve counts are on the low side; executed at the client
+def ecm_parameters(digits):
+    table = ((15, 2000, 25), (20, 11000, 90), (25, 50000, 300), (30, 250000, 700),
+             (35, 1000000, 1800), (40, 3000000, 5100), (45, 11000000, 10600), (50, 43000000, 19300))
+    for limit, B1, curves in table:
+        if (digits <= limit):
+            break
+    return (B1, 100 * B1, curves)
+
+
+# factor base for the quadratic sieve: 2 and the odd primes p for which
+# semi_prime is a square mod p, as (p, sqrt(semi_prime) mod p), with
+# 'size' primes in all; a prime that divides semi_prime is included with
+# root 0 so that the caller can spot it; executed at the client
+def siqs_factor_base(semi_prime, size):
+    import math
+
+    # square root of n mod an odd prime p, by Tonelli-Shanks
+    def sqrtMod(n, p):
+        n %= p
+        if (p % 4 == 3):
+            return pow(n, (p + 1) // 4, p)
+        q, s = p - 1, 0
+        while (q % 2 == 0):
+            q, s = q // 2, s + 1
+        z = 2
+        while pow(z, (p - 1) // 2, p) != p - 1:
+            z += 1
+        m, c, t, r = s, pow(z, q, p), pow(n, q, p), pow(n, (q + 1) // 2, p)
+        while (t != 1):
+            i, t2 = 0, t
+            while (t2 != 1):
+                t2, i = t2 * t2 % p, i + 1
+            b = pow(c, 1 << (m - i - 1), p)
+            m, c, t, r = i, b * b % p, t * b * b % p, r * b % p
+        return r
+
+    factor_base = [(2, semi_prime % 2)]
+    p = 3
+    while (len(factor_base) < size):
+        if all(p % q for q in range(3, math.isqrt(p) + 1, 2)):
+            if (semi_prime % p == 0):
+                factor_base.append((p, 0))
+            elif pow(semi_prime, (p - 1) // 2, p) == 1:
+                factor_base.append((p, sqrtMod(semi_prime, p)))
+        p += 2
+    return factor_base
+
+
+# size of the factor base and the sieve interval half width for a
+# semi-prime of 'digits' digits, following the usual SIQS tables;
+# executed at the client
+def siqs_parameters(digits):
+    table = ((20, 100, 8192), (25, 150, 16384), (30, 250, 16384), (35, 400, 32768), (40, 700, 32768),
+             (45, 1100, 65536), (50, 1600, 65536), (55, 2300, 65536), (60, 3200, 98304))
+    for limit, size, M in table:
+        if (digits <= limit):
+            break
+    return (size, M)
+
+
+# pick the q's of a new A = q_1 * ... * q_s close to sqrt(2 * semi_prime) / M
+# from the upper part of the factor base, never the same set twice;
+# executed at the client
+def siqs_choose_a(semi_prime, factor_base, M, used):
+    import math, random
+
+    target = math.isqrt(2 * semi_prime) // M
+    pool = [i for i in range(len(factor_base) // 3, len(factor_base)) if factor_base[i][1] != 0]
+    typical = factor_base[pool[len(pool) // 2]][0]
+    s = max(1, int(round(math.log(max(target, 2)) / math.log(typical))))
+    for attempt in range(1000):
+        chosen = random.sample(pool, min(s - 1, len(pool) - 1))
+        product = 1
+        for i in chosen:
+            product *= factor_base[i][0]
+        rest = max(target // product, 1)
+        last = min([i for i in pool if i not in chosen], key=lambda i: abs(factor_base[i][0] - rest))
+        a_indices = tuple(sorted(chosen + [last]))
+        if (a_indices not in used):
+            break
+    used.add(a_indices)
+    return a_indices
+
+
+# linear algebra over GF(2) and the square root step: relations with a
+# prime no other relation has are dropped first, over and over (the
+# cheap part of structured Gaussian elimination), then Gaussian
+# elimination on bit packed rows finds sets of relations whose product
+# is a square, y^2 = x^2 mod semi_prime, and gcd(y - x, semi_prime) may
+# split it. 'relations' are (y, factor base indices, large prime
+# product); returns the factors, or (0, 0); executed at the client
+def siqs_combine(semi_prime, factor_base, relations):
+    import math
+
+    # parity vector of each relation, column 0 is the sign
+    rows = []
+    for y, indices, large in relations:
+        mask = 0
+        for index in indices:
+            mask ^= 1 << (index + 1)
+        rows.append(mask)
+
+    # drop relations with a singleton column until there are none left
+    live = list(range(len(relations)))
+    while True:
+        weight = {}
+        for r in live:
+            mask = rows[r]
+            while mask:
+                column = mask & -mask
+                weight[column] = weight.get(column, 0) + 1
+                mask ^= column
+        singletons = 0
+        for column, count in weight.items():
+            if (count == 1):
+                singletons |= column
+        if (singletons == 0):
+            break
+        live = [r for r in live if (rows[r] & singletons) == 0]
+
+    # Gaussian elimination, keeping track of which relations went into each row
+    pivots = {}
+    for position, r in enumerate(live):
+        row, history = rows[r], 1 << position
+        while row:
+            column = row.bit_length() - 1
+            if column not in pivots:
+                pivots[column] = (row, history)
+                break
+            row ^= pivots[column][0]
+            history ^= pivots[column][1]
+        if row:
+            continue
+
+        # a dependency: the product of these relations is a square
+        x, y, exponents = 1, 1, {}
+        for bit in range(len(live)):
+            if (history >> bit) & 1:
+                value, indices, large = relations[live[bit]]
+                x = x * value % semi_prime
+                y = y * large % semi_prime
+                for index in indices:
+                    exponents[index] = exponents.get(index, 0) + 1
+        for index, exponent in exponents.items():
+            if (index >= 0):
+                y = y * pow(factor_base[index][0], exponent // 2, semi_prime) % semi_prime
+        factor = math.gcd(x - y, semi_prime)
+        if (1 < factor < semi_prime):
+            return (factor, semi_prime // factor)
     return (0, 0)
 
 
+# dispy's per job scheduling and pickling overhead swamps small jobs, and
+# long ones straggle at the end of a run, so the chunk size is steered by
+# the jobs as they finish: a least squares fit of job time = overhead +
+# candidates * cost over the last 'tune_jobs' jobs gives the overhead, a
+# moving average of each node's candidates per second (nodes differ)
+# gives the work a job gets through, and the chunk size moves to what
+# takes about 'target_duration' seconds on an average node, at most 8x
+# either way at a time (the short jobs at the end do not drag it down) and only when it is off by more than a fifth;
+# executed at the client with 'jobs_cond' held
+def tune_granularity(job, size, candidates):
+    global granularity, tune_overhead, tune_cost
+
+    if (job.start_time is None) or (job.end_time is None) or (candidates == 0):
+        return
+    seconds = max(job.end_time - job.start_time, 1e-6)
+    tune_samples.append((candidates, seconds))
+
+    # least squares fit of time against candidates over the recent jobs
+    tune_overhead, tune_cost = job_tuning.fit_job_time(tune_samples)
+
+    # candidates per second on this node once the overhead is paid
+    rate = candidates / max(seconds - tune_overhead, 1e-6)
+    node = job.ip_addr
+    node_rates[node] = rate if node not in node_rates else 0.75 * node_rates[node] + 0.25 * rate
+
+    # the chunk size that takes 'target_duration' on an average node; a
+    # chunk holds fewer candidates than its size for trial division, which
+    # only screens the odd numbers
+    mean_rate = sum(node_rates.values()) / len(node_rates)
+    if (target_duration > tune_overhead):
+        best = (target_duration - tune_overhead) * mean_rate * size / candidates
+    else:
+        best = granularity * 8.0    # the overhead alone is over target, go as large as allowed
+    best = int(min(max(best, granularity / 8.0, 1), granularity * 8.0))
+    if (abs(best - granularity) > granularity / 5.0):
+        dispy.logger.info('chunk size %i -> %i: job %i took %.3f sec, overhead %.3f sec, %.0f candidates/sec per job on %i nodes',
+                          granularity, best, job.id, seconds, tune_overhead, mean_rate, len(node_rates))
+        granularity = best
+
+# near the end of the search, chunks are cut down so that the last jobs
+# finish together instead of a few full size ones straggling: once less
+# is left than two tuned chunks for each job slot, the tuned size is
+# halved until it fits in half an even share of what is left (guided
+# self-scheduling), down to an eighth; executed at the client with
+# 'jobs_cond' held
+def tail_chunk(remaining):
+    share = remaining // (2 * lower_bound)
+    chunk = granularity
+    while (chunk > share) and (chunk > granularity // 8):
+        chunk //= 2
+    return max(chunk, 1)
+
+# save the progress of a trial or fermat search to the --checkpoint file,
+# once its interval has passed or when 'force' is set: the ranges done,
+# those in flight and any factor found; executed at the client with
+# 'jobs_cond' held
+def save_checkpoint(force=False):
+    if (saver is None) or not (force or saver.due()):
+        return
+    saver.save({'semi_prime': semi_prime, 'method': method, 'order': order,
+                'done': done.runs, 'in_flight': sorted(job_ranges.values()), 'factors': factors,
+                'prefilter_counts': prefilter_counts, 'sieve_counts': sieve_counts, 'chunk': granularity})
+
+# stop the cluster once a factor is known: every node that has run a job
+# is sent the file 'factor_found', and the jobs still pending are
+# cancelled through dispy, which drops the queued ones and terminates the
+# running ones. A running job may not see the cancel for a while, so the
+# node functions also call 'factor_found' between blocks of their search
+# and give up once it is True; dispy ships it to the nodes with them
+# (depends=), and it looks for the file in the job's working directory
+def factor_found(): # executed on the nodes
+    import os
+    return os.path.exists('factor_found')
+
+# send the stop file and cancel the jobs in 'unfinished'; returns the
+# number of jobs cancelled; executed at the client
+def stop_cluster(cluster, unfinished, nodes):
+    import os, tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'factor_found')
+    with open(path, 'w') as f:
+        f.write('%i\n' % semi_prime)
+    for node in nodes:
+        try:
+            cluster.send_file(path, node)
+        except Exception as e:
+            dispy.logger.warning('could not send %s to %s: %s', path, node, e)
+
+    cancelled = 0
+    for job in unfinished:
+        if (cluster.cancel(job) == 0):
+            cancelled += 1
+    return cancelled
+
 # dispy calls this function to indicate change in job status
 def job_callback(job): # executed at the client
     global pending_jobs, jobs_cond
-    global found
+    global found, prefilter_counts, walks_done, steps_walked, sieve_counts, curves_done
+    global polynomials_sieved, combined_relations, factors
 
     if (job.status == dispy.DispyJob.Finished  # most usual case
         or job.status in (dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled,
@@ -157,16 +871,66 @@ def job_callback(job): # executed at the client
         # 'pending_jobs' is shared between two threads, so access it with
         # 'jobs_cond' (see below)
         jobs_cond.acquire()
+        if job.ip_addr:
+            nodes.add(job.ip_addr)    # the nodes to stop once a factor is found
         if job.id: # job may have finished before 'main' assigned id
             pending_jobs.pop(job.id)
+            size = job_sizes.pop(job.id)
 
             # extract the results for each job as it happens
-            factor1, factor2 = job.result	# returns results from job
-            if (factor1 != 0):
-                found = True
-                dispy.logger.info('job "%i" returned %i * %i = %i, %s jobs pending', job.id, factor1, factor2, factor1 * factor2, len(pending_jobs))
+            if (job.status == dispy.DispyJob.Finished):
+                if (method == 'rho'):
+                    factor1, factor2, walked = job.result    # a factor, or how far the walk got
+                    walks_done += 1
+                    steps_walked += walked
+                    if (walks_done % 100 == 0):
+                        dispy.logger.info('%i walks finished, %i steps walked', walks_done, steps_walked)
+                elif (method == 'ecm'):
+                    factor1, factor2, curves = job.result    # a factor, or the curves run
+                    curves_done += curves
+                    dispy.logger.info('%i curves run, about %i more expected for a %i digit factor', curves_done, max(expected_curves - curves_done, 0), factor_digits)
+                elif (method == 'siqs'):
+                    found_relations, found_partials, polynomials = job.result    # relations, for the client to combine
+                    factor1, factor2 = 0, 0
+                    polynomials_sieved += polynomials
 
-            if len(pending_jobs) <= lower_bound:
+                    # the same relation can turn up twice; two partials
+                    # with the same large prime make one more relation
+                    for y, indices in found_relations:
+                        relations.setdefault(y, (y, indices, 1))
+                    for y, indices, large in found_partials:
+                        if large not in partials:
+                            partials[large] = (y, indices)
+                        elif (partials[large][0] != y):
+                            y0, indices0 = partials[large]
+                            if (y0 * y % semi_prime) not in relations:
+                                relations[y0 * y % semi_prime] = (y0 * y % semi_prime, indices0 + indices, large)
+                                combined_relations += 1
+                    if (job.id % 10 == 0):
+                        dispy.logger.info('%i relations (%i from partials) of %i needed, %i partials, %i polynomials sieved', len(relations), combined_relations, relations_needed, len(partials), polynomials_sieved)
+                elif (method == 'fermat'):
+                    factor1, factor2, counts = job.result	# returns results from job
+                    sieve_counts = [a + b for a, b in zip(sieve_counts, counts)]
+                    if auto_tune:
+                        tune_granularity(job, size, counts[0])
+                else:
+                    factor1, factor2, counts = job.result	# returns results from job
+                    prefilter_counts = [a + b for a, b in zip(prefilter_counts, counts)]
+                    if auto_tune:
+                        tune_granularity(job, size, counts[0])
+                if (factor1 != 0) and (found == False):
+                    found = True
+                    factors = [factor1, factor2]
+                    dispy.logger.info('job "%i" returned %i * %i = %i, %s jobs pending', job.id, factor1, factor2, factor1 * factor2, len(pending_jobs))
+
+            # a range is done once its job has finished; the ranges of
+            # jobs that failed are left for a resumed run
+            bounds = job_ranges.pop(job.id, None)
+            if (bounds is not None) and (job.status == dispy.DispyJob.Finished):
+                done.add(*bounds)
+            save_checkpoint(force=found)
+
+            if len(pending_jobs) <= lower_bound or found:
                 jobs_cond.notify()
 
         jobs_cond.release()
@@ -175,7 +939,8 @@ def job_callback(job): # executed at the client
 
 # main loop
 if __name__ == '__main__':
-    import dispy, random, math, argparse, resource, threading, logging
+    import dispy, random, math, argparse, resource, threading, logging, collections
+    import search_plan, checkpoint, job_tuning, os
 
     # set lower and upper bounds as appropriate
     # lower_bound is at least num of cpus and upper_bound is roughly 3x lower_bound
@@ -187,12 +952,36 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument("semi_prime", type=int, help="semi-prime number")
-    parser.add_argument("chunk_scale", type=int, help="chunk size = chunk_scale * log(semi-prime)")
+    parser.add_argument("chunk_scale", type=int, help="chunk size = chunk_scale * log(semi-prime) for the trial and fermat methods, ignored by the others")
+    parser.add_argument("--method", choices=["trial", "rho", "fermat", "ecm", "siqs"], default="trial", help="trial division below the square root, independent Pollard rho walks, Fermat's difference of squares for balanced factors, elliptic curves for unbalanced ones, or the self-initialising quadratic sieve")
+    parser.add_argument("--order", choices=sorted(search_plan.PLANS), default="down", help="order of the trial method's chunks: down from the square root, interleaved with chunks up from 3, or up from the square root")
+    parser.add_argument("--walk-steps", type=int, default=None, help="steps in each rho walk, 4 * semi-prime^(1/4) if not given")
+    parser.add_argument("--gcd-batch", type=int, default=128, help="rho steps multiplied together between gcds")
+    parser.add_argument("--factor-digits", type=int, default=None, help="size of the factor ECM is tuned for, half the digits of the semi-prime if not given")
+    parser.add_argument("--curves-per-job", type=int, default=4, help="ECM curves run by each job")
+    parser.add_argument("--auto-tune", action="store_true", help="resize chunks from the measured job times to take about --target-duration seconds, and shrink them near the end of the search; starts from chunk_scale")
+    parser.add_argument("--target-duration", type=float, default=3.0, help="job duration in seconds aimed for by --auto-tune")
+    parser.add_argument("--cache", help="prime cache file; chunks it already holds are searched through its primes instead of on the cluster")
+    parser.add_argument("--checkpoint", help="file the progress of the trial and fermat methods is saved to as the run goes")
+    parser.add_argument("--checkpoint-interval", type=float, default=60.0, help="seconds between saves of --checkpoint")
+    parser.add_argument("--resume", action="store_true", help="carry on from --checkpoint, submitting only the ranges not done yet")
     args = parser.parse_args()
+    if args.checkpoint and (args.method not in ('trial', 'fermat')):
+        parser.error('--checkpoint is for the trial and fermat methods')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if args.checkpoint and (not args.resume) and os.path.exists(args.checkpoint):
+        parser.error('%s exists, add --resume to carry on from it' % args.checkpoint)
+    if (args.method in ('rho', 'ecm', 'siqs')) and ((args.semi_prime < 4) or (pow(2, args.semi_prime - 1, args.semi_prime) == 1)):
+        parser.error('%i is prime, or too small, for %s to find a factor' % (args.semi_prime, args.method))
 
     # this is the number we hve been given to factor
     semi_prime = args.semi_prime
     chunk_scale = args.chunk_scale
+    method = args.method
+    order = args.order
+    auto_tune = args.auto_tune
+    target_duration = args.target_duration
 
     server_nodes ='192.168.1.*'
 
@@ -200,53 +989,256 @@ if __name__ == '__main__':
     # 'job_callback' is executed in another thread
     jobs_cond = threading.Condition()
 
-    # assume that the prime factors are roughly the same length
-    # we can start our search from the square root
-    lower = int( math.sqrt(semi_prime) )
-    if (lower % 2) == 0: lower += 1    # make sure we start with an odd number (which could also be prime) 
-    upper = semi_prime / 2             # make sure we seach far enough
-
-    # the chunk size is the search space starting from 'lower'
+    # the chunk size is the search space in each job
     #chunk = int (0.0000000001 * lower)
     chunk = int ( chunk_scale * math.log(semi_prime) )
 
+    # the smaller prime factor is at most the square root, so the trial
+    # method searches chunks of 3 .. isqrt(semi_prime) in the order of
+    # the search plan; the plan asks for the chunk size as it goes, which
+    # the tuner (if enabled) may have changed
+    chunks = search_plan.PLANS[args.order](semi_prime, lambda: chunk)
+    search_lower, search_upper = search_plan.plan_span(args.order, semi_prime)
+
+    # Fermat's method searches a = (p + q) / 2 instead, from the square
+    # root (rounded up) to where the smaller factor would be 3
+    if (method == 'fermat'):
+        search_lower, search_upper = math.isqrt(semi_prime - 1) + 1, (semi_prime // 3 + 3) // 2
+        chunks = search_plan.plan_range(search_lower, search_upper, lambda: chunk)
+    remaining = search_upper - search_lower + 1    # not yet handed out
+
+    # a rho walk finds a factor p in about sqrt(p) steps, and p is at most
+    # sqrt(semi_prime); walks are cut off after 'walk_steps' and a new one
+    # started with another constant and seed
+    walk_steps = args.walk_steps or 4 * math.isqrt(math.isqrt(semi_prime))
+    gcd_batch = args.gcd_batch
+    walks_done, steps_walked = 0, 0
+
+    # ECM bounds are set for the factor size aimed for, and the curves
+    # expected for it are counted down as the jobs finish
+    factor_digits = args.factor_digits or (len(str(semi_prime)) + 1) // 2
+    B1, B2, expected_curves = ecm_parameters(factor_digits)
+    curves_per_job = args.curves_per_job
+    curves_done = 0
+
+    # the quadratic sieve jobs share one factor base, each sieves the
+    # polynomials of one A, and the client runs the linear algebra once
+    # there are more relations than primes in the factor base
+    if (method == 'siqs'):
+        factor_base_size, M = siqs_parameters(len(str(semi_prime)))
+        factor_base = siqs_factor_base(semi_prime, factor_base_size)
+        large_prime_bound = min(128 * factor_base[-1][0], factor_base[-1][0] ** 2)
+        relations_needed = len(factor_base) + 21
+    relations, partials, used_a = {}, {}, set()
+    polynomials_sieved, combined_relations = 0, 0
+
+    # the tuner (if enabled) moves the chunk size as the jobs finish, and
+    # the chunk sizes it picks are logged and kept as (first job, size)
+    granularity = chunk
+    tune_jobs = 4 * upper_bound
+    tune_samples = collections.deque(maxlen=tune_jobs)
+    tune_overhead, tune_cost = 0.0, 0.0
+    node_rates = {}    # candidates per second of a job, by node
+    chunk_schedule = [(1, chunk)]
+    job_sizes = {}
+
     pending_jobs = {}
-    cluster = dispy.JobCluster(find_factor, nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+    nodes = set()    # addresses of the nodes that have run jobs
+    if (method == 'rho'):
+        cluster = dispy.JobCluster(rho_factor, depends=[factor_found], nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+        print(('Pollard rho walks of %i steps selected, gcd every %i steps' % (walk_steps, gcd_batch)))
+    elif (method == 'ecm'):
+        cluster = dispy.JobCluster(ecm_factor, depends=[factor_found], nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+        print(('ECM selected for a %i digit factor, B1 = %i, B2 = %i, about %i curves expected, %i per job' % (factor_digits, B1, B2, expected_curves, curves_per_job)))
+    elif (method == 'siqs'):
+        cluster = dispy.JobCluster(siqs_sieve, depends=[factor_found], nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+        print(('SIQS selected, %i primes in the factor base up to %i, sieve interval %i' % (len(factor_base), factor_base[-1][0], 2 * M)))
+    elif (method == 'fermat'):
+        cluster = dispy.JobCluster(fermat_factor, depends=[factor_found], nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+        print('Fermat difference of squares selected')
+    else:
+        cluster = dispy.JobCluster(find_factor, depends=[factor_found], nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
 
     print(('Finding prime factors for %i on cluster %s' % (semi_prime, server_nodes)))
 
+    # with --cache, chunks that the prime cache already holds are searched
+    # here through its primes instead of being submitted; nothing is
+    # sieved into it here, as that is the cluster's work
+    cache = None
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache, fill_limit=0)
+
     # search for prime factors between the lower and upper limits
     found = False
+    prefilter_counts = [0, 0, 0, 0, 0]    # totals of the 'find_factor' counts
+    sieve_counts = [0, 0, 0]    # totals of the 'fermat_factor' counts
     i = 1
-    while (lower <= upper) and (found == False):
-        print(('Attempting factors in range %i - %i, chunk size %i' % (lower, lower+chunk, chunk) ))
+
+    # with --checkpoint the ranges done are saved as the jobs finish, and
+    # with --resume the run carries on from them: the plan is walked again
+    # from the start, but only the parts of its chunks not done yet (which
+    # include those in flight when the checkpoint was saved) are submitted
+    done = checkpoint.IntervalSet(step=1 if (method == 'fermat') else 2)
+    job_ranges = {}    # (lower, upper) of the jobs in flight, by id
+    factors = None
+    saver = None
+    if args.checkpoint:
+        saver = checkpoint.Checkpoint(args.checkpoint, args.checkpoint_interval)
+    if args.resume:
+        state = checkpoint.load(args.checkpoint)
+        if (state['semi_prime'], state['method'], state['order']) != (semi_prime, method, order):
+            parser.error('%s is the checkpoint of a %s search of %i in %s order' % (args.checkpoint, state['method'], state['semi_prime'], state['order']))
+        done = checkpoint.IntervalSet(state['done'], done.step)
+        factors = state['factors']
+        prefilter_counts, sieve_counts = state['prefilter_counts'], state['sieve_counts']
+        chunk = granularity = state['chunk']
+        chunk_schedule = [(1, chunk)]
+        remaining -= done.size()
+        chunks = (piece for bounds in chunks for piece in done.gaps(*bounds))
+        print(('Resuming from %s: %i ranges done, %i that were in flight resubmitted' % (args.checkpoint, len(state['done']), len(state['in_flight']))))
+        if (factors is not None):
+            found = True
+            print(('%i * %i = %i, found before the checkpoint' % (factors[0], factors[1], semi_prime)))
+    # a square, or a prime of the factor base dividing it, leaves nothing to sieve for
+    if (method == 'siqs'):
+        for factor1 in [math.isqrt(semi_prime)] + [p for p, t in factor_base if t == 0]:
+            if (factor1 > 1) and (semi_prime % factor1 == 0):
+                found = True
+                print(('%i * %i = %i' % (factor1, semi_prime // factor1, semi_prime)))
+                break
+
+    while (method in ('rho', 'ecm', 'siqs')) and (found == False):
+        if (method == 'siqs') and (len(relations) >= relations_needed):
+            # enough relations for the linear algebra, which runs here
+            # while the jobs already submitted carry on
+            jobs_cond.acquire()
+            collected = list(relations.values())
+            jobs_cond.release()
+            factor1, factor2 = siqs_combine(semi_prime, factor_base, collected)
+            if (factor1 != 0):
+                jobs_cond.acquire()
+                found = True
+                jobs_cond.release()
+                print(('linear algebra on %i relations found %i * %i = %i' % (len(collected), factor1, factor2, semi_prime)))
+                break
+            relations_needed = len(collected) + 20    # unlucky, collect some more
+
+        if (method == 'siqs'):
+            # the polynomials of a new A
+            a_indices = siqs_choose_a(semi_prime, factor_base, M, used_a)
+            job = cluster.submit(semi_prime, factor_base, a_indices, M, large_prime_bound)
+        elif (method == 'ecm'):
+            # a batch of random curves, avoiding the sigmas that give
+            # degenerate ones
+            sigmas = [random.randrange(6, semi_prime - 1) for c in range(curves_per_job)]
+            job = cluster.submit(semi_prime, sigmas, B1, B2)
+        else:
+            # every walk has its own polynomial constant (not 0 or -2, whose
+            # walks are degenerate) and starting point
+            constant = random.randrange(1, semi_prime - 2)
+            seed = random.randrange(0, semi_prime)
+
+            # schedule execution of rho_factor (running 'dispynode')
+            job = cluster.submit(semi_prime, constant, seed, walk_steps, gcd_batch)
+
+        jobs_cond.acquire()
+
+        job.id = i # associate an ID to the job
+        job_sizes[i] = walk_steps if (method == 'rho') else curves_per_job if (method == 'ecm') else M
+
+        # there is a chance the job may have finished and job_callback called by
+        # this time, so put it in 'pending_jobs' only if job is pending
+        if job.status == dispy.DispyJob.Created or job.status == dispy.DispyJob.Running:
+            pending_jobs[i] = job
+            if len(pending_jobs) >= upper_bound:
+                while len(pending_jobs) > lower_bound and (found == False):
+                    jobs_cond.wait()
+        jobs_cond.release()
+
+        i += 1     # next walk, batch of curves or A
+
+    while (method in ('trial', 'fermat')) and (found == False):
+        if auto_tune:
+            jobs_cond.acquire()
+            chunk = tail_chunk(remaining)
+            if (chunk != chunk_schedule[-1][1]):
+                chunk_schedule.append((i, chunk))
+                dispy.logger.info('chunk size %i from job %i%s', chunk, i, ', near the end of the search' if chunk < granularity else '')
+            jobs_cond.release()
+        lower, upper = next(chunks, (None, None))    # next chunk of the plan
+        if (lower is None):
+            break
+        remaining -= upper - lower + 1
+        print(('Attempting factors in range %i - %i, chunk size %i' % (lower, upper, chunk) ))
+
+        result = cached_factor(cache, semi_prime, lower, upper) if (cache and method == 'trial') else None
+        if (result is not None):
+            factor1, factor2, counts = result
+            jobs_cond.acquire()
+            done.add(lower, upper)
+            if (factor1 != 0):
+                found = True
+                factors = [factor1, factor2]
+                dispy.logger.info('cache returned %i * %i = %i', factor1, factor2, factor1 * factor2)
+            save_checkpoint(force=found)
+            jobs_cond.release()
+            continue
 
         # schedule execution of find_factor (running 'dispynode')
-        job = cluster.submit(semi_prime, lower, lower+chunk)
+        job = cluster.submit(semi_prime, lower, upper)
 
         jobs_cond.acquire()
 
         job.id = i # associate an ID to the job
+        job_sizes[i] = upper - lower + 1
 
         # there is a chance the job may have finished and job_callback called by
         # this time, so put it in 'pending_jobs' only if job is pending
         if job.status == dispy.DispyJob.Created or job.status == dispy.DispyJob.Running:
             pending_jobs[i] = job
+            job_ranges[i] = (lower, upper)
             # dispy.logger.info('job "%s" submitted: %s', i, len(pending_jobs))
             if len(pending_jobs) >= upper_bound:
-                while len(pending_jobs) > lower_bound:
+                while len(pending_jobs) > lower_bound and (found == False):
                     jobs_cond.wait()
         jobs_cond.release()
 
-        # next chunk (make sure it's prime)
-        lower += chunk
-        if (lower % 2) == 0: lower += 1
-
         i += 1     # next job
 
+    if (found == True):
+        # the answer is known, so the jobs still queued or running are no
+        # use, and 'cluster.wait' would otherwise wait for every one of them
+        jobs_cond.acquire()
+        unfinished = list(pending_jobs.values())
+        running = set([job.ip_addr for job in unfinished if job.ip_addr])
+        jobs_cond.release()
+        cancelled = stop_cluster(cluster, unfinished, nodes | running)
+        print(('cancelled %i of %i jobs still pending' % (cancelled, len(unfinished))))
+
     cluster.wait()
+    if (saver is not None):
+        jobs_cond.acquire()
+        save_checkpoint(force=True)
+        jobs_cond.release()
 
     if (found == False): print( 'No factors found' )
+    if (method == 'rho'):
+        print(('%i rho walks finished, %i steps walked' % (walks_done, steps_walked)))
+    if (method == 'siqs'):
+        print(('%i relations (%i from partials), %i polynomials sieved' % (len(relations), combined_relations, polynomials_sieved)))
+    if (method == 'ecm'):
+        print(('%i curves run, %i expected for a %i digit factor' % (curves_done, expected_curves, factor_digits)))
+    if auto_tune:
+        print(('chunk size tuned to %i (overhead %.3f sec, %.3e sec per candidate over the last %i jobs)' % (granularity, tune_overhead, tune_cost, len(tune_samples)) ))
+        print(('chunk schedule (from job: size): %s' % ', '.join(['%i: %i' % step for step in chunk_schedule]) ))
+        for node in sorted(node_rates):
+            print(('  %s: %.0f candidates/sec per job' % (node, node_rates[node]) ))
+
+    if (method == 'fermat'):
+        print(('residue sieves: %i values of a, %i rejected, %i square roots taken' % tuple(sieve_counts)))
+    if (method == 'trial'):
+        print(('small prime prefilter: %i screened, %i rejected by trial division, %i rejected by gcd, %i passed on; %i tested after the product tree screen' % tuple(prefilter_counts)))
 
     cluster.print_status()
     cluster.close()
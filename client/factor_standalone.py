@@ -4,6 +4,10 @@
 # show the difference in run time with similar code running on the
 # Octapi cluster using Dispy.
 #
+# With --method fermat it looks for a^2 - semi-prime being a square
+# instead of dividing by candidate primes, which finds balanced factors
+# in very few steps.
+#
 
 # Primality test algorithms derived from code by Shay Margalit, 12 Dec 2013
 # https://www.codeproject.com/articles/691200/primality-test-algorithms-prime-test-the-fastest-w
@@ -18,164 +22,236 @@
 
 # All other original code: Crown Copyright 2016, 2017 
 
+# GMP arithmetic where gmpy2 is installed, chosen once (see arithmetic.py)
+from arithmetic import isqrt
+
+# the tests shared by the standalone scripts (see primality_tests.py)
+from primality_tests import DeterministicPrimalityTest, smallPrimorial, smallPrimeFilter
+
 
 def find_factor(semi_prime, lower, upper):
 
-    def naivePrimalityTest(number):
+    # gcd screen of a block of candidates: a product tree is built over
+    # them, kept mod semi_prime as only the gcd with it matters, and only
+    # the subtrees whose product shares a factor with semi_prime are
+    # searched; returns the candidates that do
+    def productTreeScreen(candidates):
         import math
 
-        if number == 2:
-           return true
-        if number % 2 == 0:
-            return False
-    
-        i = 3
-        sqrtOfNumber = math.sqrt(number)
-    
-        while i <= sqrtOfNumber:
-            if number % i == 0:
-                return False
-            i = i+2
-        
-        return True
-
-    def FermatPrimalityTest(number):
-        import random, math
-
-        # if number != 1
-        if (number > 1):
-            # repeat the test few times
-            for time in range(3):
-                # Draw a RANDOM number in range of number ( Z_number )
-                randomNumber = random.randint(2, number)-1
-            
-                # Test if a^(n-1) = 1 mod n
-                if ( pow(randomNumber, number-1, number) != 1 ):
-                    return False
-        
-            return True
-        else:
-            # case number == 1
-            return False
-
-    def MillerRabinPrimalityTest(number):
-        import random, math
-    
-        # because the algorithm input is ODD number than if we get
-        # even and it is the number 2 we return TRUE ( spcial case )
-        # if we get the number 1 we return false and any other even 
-        # number we will return false.
-    
-        if number == 2:
-            return True
-        elif number == 1 or number % 2 == 0:
-            return False
-    
-        # first we want to express n as : 2^s * r ( were r is odd )
-    
-        # the odd part of the number
-        oddPartOfNumber = number - 1
-    
-        # The number of time that the number is divided by two
-        timesTwoDividNumber = 0
-    
-        # while r is even divid by 2 to find the odd part
-        while oddPartOfNumber % 2 == 0:
-            oddPartOfNumber = oddPartOfNumber // 2
-            timesTwoDividNumber = timesTwoDividNumber + 1 
-     
-    
-        # since there are number that are cases of "strong liar" we 
-        # need to check more then one number
-    
-        for time in range(3):
-        
-            # choose "Good" random number
-            while True:
-                # Draw a RANDOM number in range of number ( Z_number )
-                randomNumber = random.randint(2, number)-1
-                if randomNumber != 0 and randomNumber != 1:
-                    break
-        
-            # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-            randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
-        
-            # if random number is not 1 and not -1 ( in mod n ) 
-            if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
-                # number of iteration
-                iterationNumber = 1
-            
-                # while we can squre the number and the squered number is not -1 mod number
-                while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
-                    # squre the number
-                    randomNumberWithPower = pow(randomNumberWithPower, 2, number)
-                
-                    # inc the number of iteration
-                    iterationNumber = iterationNumber + 1
-                
-                # if x != -1 mod number then it because we did not found strong witnesses
-                # hence 1 have more then two roots in mod n ==>
-                # n is composite ==> return false for primality
-            
-                if (randomNumberWithPower != (number - 1)):
-                    return False
-            
-        # well the number pass the tests ==> it is probably prime ==> return true for primality
-        return True 
-
-
-    # search between the lower and upper limits
-    while (lower <= upper):
-        factor1 = lower
-        # only test prime numbers
-        if MillerRabinPrimalityTest(factor1) and FermatPrimalityTest(factor1):
-            if (semi_prime % factor1 == 0):
-                factor2 = semi_prime // factor1
-                
-                # try this prime to see if it is a factor
-                if (factor1 * factor2 == semi_prime):
-                    #print ('%i * %i = %i' % (factor1, factor2, factor1*factor2))
-                    return (factor1, factor2)
+        if not candidates:
+            return []
+        tree = [candidates]
+        while len(tree[-1]) > 1:
+            level = tree[-1]
+            products = [level[i] * level[i + 1] % semi_prime for i in range(0, len(level) - 1, 2)]
+            if (len(level) % 2):
+                products.append(level[-1])
+            tree.append(products)
+
+        hits = []
+        search = [(len(tree) - 1, 0)]    # (level, index) from the root down
+        while search:
+            depth, index = search.pop()
+            if math.gcd(tree[depth][index], semi_prime) == 1:
+                continue
+            if (depth == 0):
+                hits.append(tree[0][index])
+            else:
+                search += [(depth - 1, child) for child in (2 * index, 2 * index + 1) if child < len(tree[depth - 1])]
+        return sorted(hits)
+
+    import math
+
+    primorial = smallPrimorial()
+    counts = [0, 0, 0, 0, 0]
 
+    # the candidates between the lower and upper limits, after a cheap
+    # screen for small factors
+    candidates = []
+    while (lower <= upper):
+        if smallPrimeFilter(lower, primorial, counts):
+            candidates.append(lower)
         lower = lower + 2    # skip even factors because they can't be prime
 
+    # one gcd rejects a run of candidates with no factor of semi_prime in
+    # it, so only the rare candidates that share a factor with it are tested
+    for candidate in productTreeScreen(candidates):
+        counts[4] += 1
+        factor1 = math.gcd(candidate, semi_prime)
+        if DeterministicPrimalityTest(factor1):
+            factor2 = semi_prime // factor1
+
+            # try this prime to see if it is a factor
+            if (factor1 * factor2 == semi_prime):
+                return (factor1, factor2, tuple(counts))
+
+    # no factors found
+    return (0, 0, tuple(counts))
+
+
+# Fermat's method over a = lower .. upper: semi_prime = a^2 - b^2 =
+# (a - b) * (a + b), so look for an a where a^2 - semi_prime is a square,
+# which for balanced factors is found close to the square root. Values of
+# a where a^2 - semi_prime is not a square mod 16, 9, 5 and 7 are never
+# visited, the ones left are checked against a few more moduli, and only
+# the survivors pay for an isqrt. Returns the factors (0, 0 if none) and
+# the counts of values of a in the range, rejected by the residue sieves
+# and checked with isqrt
+def fermat_factor(semi_prime, lower, upper):
+    import math
+
+    if (semi_prime % 2) == 0:
+        return (2, semi_prime // 2, (0, 0, 0))
+
+    # table[r] is True if r * r - semi_prime is a square mod m
+    def residueTable(m):
+        squares = set([x * x % m for x in range(m)])
+        return [((r * r - semi_prime) % m) in squares for r in range(m)]
+
+    # the offsets of a mod 'stride' that pass all of its moduli
+    stride = 16 * 9 * 5 * 7
+    passes = [residueTable(m) for m in (16, 9, 5, 7)]
+    offsets = [r for r in range(stride) if passes[0][r % 16] and passes[1][r % 9] and passes[2][r % 5] and passes[3][r % 7]]
+    tables = [(m, residueTable(m)) for m in (11, 13, 17, 19, 23, 29, 31, 37)]
+
+    checked = 0
+    for block in range(lower - lower % stride, upper + 1, stride):
+        for offset in offsets:
+            a = block + offset
+            if (a < lower) or (a > upper):
+                continue
+            if all(table[a % m] for m, table in tables):
+                checked += 1
+                b2 = a * a - semi_prime
+                b = isqrt(b2)
+                if (b * b == b2) and (a - b > 1):
+                    return (int(a - b), int(a + b), (a - lower + 1, a - lower + 1 - checked, checked))
+
     # no factors found
-    return (0, 0)
+    return (0, 0, (upper - lower + 1, upper - lower + 1 - checked, checked))
+
+
+# search a chunk through the primes that the prime cache holds for it;
+# returns the same as 'find_factor', or None if the cache cannot cover
+# the chunk; executed at the client
+def cached_factor(cache, semi_prime, lower, upper):
+    primes = cache.primes_in_range(lower, upper)
+    if primes is None:
+        return None
+    for factor1 in primes:
+        if (semi_prime % factor1 == 0):
+            return (factor1, semi_prime // factor1, (0, 0, 0, 0, 0))
+    return (0, 0, (0, 0, 0, 0, 0))
 
 
 # main loop
 if __name__ == '__main__':
-    import random, math
+    import random, math, argparse, concurrent.futures
+    import search_plan
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of local processes to search chunks on")
+    parser.add_argument("--method", choices=["trial", "fermat"], default="trial", help="trial division below the square root, or Fermat's difference of squares for balanced factors")
+    parser.add_argument("--order", choices=sorted(search_plan.PLANS), default="down", help="order of the trial method's chunks: down from the square root, interleaved with chunks up from 3, or up from the square root")
+    parser.add_argument("--cache", help="prime cache file; chunks it already holds are searched through its primes")
+    args = parser.parse_args()
+
+    workers = args.workers
+    method = args.method
+
+    # chunks are far smaller than a cache segment, so sieving a segment
+    # in for one would cost more than the chunk; only read what is stored
+    cache = None
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache, fill_limit=0)
 
     # this is the number we have been given to factor
     semi_prime = int( input( "What semi-prime number do you want to try and factor? " ) )
     # chunk size = chunk_scale * log(semi-prime)
     chunk_scale = int( input( "What scale of search chunk size do you want? (generally 100 - 1000) ") )
 
-    # assume that the prime factors are roughly the same length
-    # we can start our search from the square root
-    lower = int( math.sqrt(semi_prime) )
-    if (lower % 2) == 0: lower += 1    # make sure we start with an odd number (which could also be prime) 
-    upper = semi_prime / 2             # make sure we seach far enough
-
-    # the chunk size is the search space starting from 'lower'
+    # the chunk size is the search space of each chunk
     chunk = int ( chunk_scale * math.log(semi_prime) )
 
+    # the smaller prime factor is at most the square root, so the trial
+    # method searches chunks of 3 .. isqrt(semi_prime) in the order of
+    # the search plan
+    search = find_factor
+    chunks = search_plan.PLANS[args.order](semi_prime, lambda: chunk)
+
+    # Fermat's method searches a = (p + q) / 2 instead, from the square
+    # root (rounded up) to where the smaller factor would be 3
+    if (method == 'fermat'):
+        search = fermat_factor
+        chunks = search_plan.plan_range(math.isqrt(semi_prime - 1) + 1, (semi_prime // 3 + 3) // 2, lambda: chunk)
+
     # search for prime factors between the lower and upper limits
     found = False
-    while (lower <= upper) and (found == False):
-        print(('Attempting factors in range %i - %i, chunk size %i' % (lower, lower+chunk, chunk) ))
+    prefilter_counts = [0, 0, 0, 0, 0]    # totals of the 'find_factor' counts
+    sieve_counts = [0, 0, 0]    # totals of the 'fermat_factor' counts
+    if (workers > 1):
+        # keep up to 3 chunks per process queued, in the same way as the
+        # bounded window of jobs used with dispy
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        pending = set()
+        exhausted = False
+        while (not exhausted or pending) and (found == False):
+            while (not exhausted) and len(pending) < 3 * workers:
+                lower, upper = next(chunks, (None, None))    # next chunk of the plan
+                if (lower is None):
+                    exhausted = True
+                    break
+                print(('Attempting factors in range %i - %i, chunk size %i' % (lower, upper, chunk) ))
+                result = cached_factor(cache, semi_prime, lower, upper) if (cache and method == 'trial') else None
+                if (result is None):
+                    pending.add(executor.submit(search, semi_prime, lower, upper))
+                else:
+                    # already done, collected with the others
+                    future = concurrent.futures.Future()
+                    future.set_result(result)
+                    pending.add(future)
+
+            # collect the chunks as they finish, in any order
+            finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                factor1, factor2, counts = future.result()
+                if (method == 'fermat'):
+                    sieve_counts = [a + b for a, b in zip(sieve_counts, counts)]
+                else:
+                    prefilter_counts = [a + b for a, b in zip(prefilter_counts, counts)]
+
+                # report the outcome
+                if (factor1 != 0) and (found == False):
+                    print(('%i * %i = %i' % (factor1, factor2, factor1*factor2)))
+                    found = True
 
-        factor1, factor2 = find_factor(semi_prime, lower, lower+chunk)
+        # chunks still queued are no longer needed
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+    else:
+        for lower, upper in chunks:
+            print(('Attempting factors in range %i - %i, chunk size %i' % (lower, upper, chunk) ))
 
-        # report the outcome
-        if (factor1 != 0):
-            print(('%i * %i = %i' % (factor1, factor2, factor1*factor2)))
-            found = True
+            result = cached_factor(cache, semi_prime, lower, upper) if (cache and method == 'trial') else None
+            if (result is None):
+                result = search(semi_prime, lower, upper)
+            factor1, factor2, counts = result
+            if (method == 'fermat'):
+                sieve_counts = [a + b for a, b in zip(sieve_counts, counts)]
+            else:
+                prefilter_counts = [a + b for a, b in zip(prefilter_counts, counts)]
 
-        # next chunk (make sure it's prime)
-        lower += chunk
-        if (lower % 2) == 0: lower += 1
+            # report the outcome
+            if (factor1 != 0):
+                print(('%i * %i = %i' % (factor1, factor2, factor1*factor2)))
+                found = True
+                break
 
     # report the outcome
     if (found == False): print ('no factors found')
+    if (method == 'fermat'):
+        print(('residue sieves: %i values of a, %i rejected, %i square roots taken' % tuple(sieve_counts)))
+    else:
+        print(('small prime prefilter: %i screened, %i rejected by trial division, %i rejected by gcd, %i passed on; %i tested after the product tree screen' % tuple(prefilter_counts)))
@@ -0,0 +1,34 @@
+# Job size tuning for the dispy clients
+# dispy's per job scheduling and pickling overhead swamps small jobs, so
+# the efficient clients time their jobs and fit
+#   job time = overhead + size * cost
+# by least squares, then size later jobs to take about a target duration.
+#
+# Usage:
+#   samples.append((size, seconds))
+#   overhead, cost = fit_job_time(samples)
+#   granularity = target_size(size, overhead, cost, target_duration)
+
+# least squares fit of job time against size over (size, seconds)
+# samples; returns (overhead in seconds, seconds per unit of size)
+def fit_job_time(samples):
+    count = len(samples)
+    mean_size = sum([s for s, t in samples]) / count
+    mean_time = sum([t for s, t in samples]) / count
+    sxx = sum([(s - mean_size) ** 2 for s, t in samples])
+    sxy = sum([(s - mean_size) * (t - mean_time) for s, t in samples])
+    if (sxx > 0) and (sxy > 0):
+        cost = sxy / sxx
+        return (max(mean_time - cost * mean_size, 0.0), cost)
+    # every sample has the same size so far, assume no overhead
+    return (0.0, mean_time / mean_size)
+
+# the job size that takes about 'target_duration', moving at most 8x
+# either way from 'size'; when the overhead alone takes the target or
+# more, jobs grow as far as allowed, as only larger jobs spread it out
+def target_size(size, overhead, cost, target_duration):
+    if (target_duration > overhead):
+        best = (target_duration - overhead) / cost
+    else:
+        best = size * 8.0
+    return int(min(max(best, size / 8.0, 1), size * 8.0))
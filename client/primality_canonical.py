@@ -25,8 +25,15 @@
 # All other original code: Crown Copyright 2016, 2017 
 
 # naive primality test
-def naivePrimalityTest(number):
+def naivePrimalityTest(number, isqrt=None):
     import math
+    if (isqrt is None):
+        # a job of one number chooses here, 'primalityBatch' chooses once
+        # for a whole batch and passes it in
+        try:
+            from gmpy2 import isqrt    # GMP arithmetic, where installed
+        except ImportError:
+            isqrt = math.isqrt
 
     if number == 2:  # obvious special case
        return (True, number)
@@ -34,7 +41,7 @@ def naivePrimalityTest(number):
         return (False, number)
     
     i = 3
-    sqrtOfNumber = math.sqrt(number)
+    sqrtOfNumber = isqrt(number)
     
     while i <= sqrtOfNumber:
         if number % i == 0:
@@ -44,8 +51,14 @@ def naivePrimalityTest(number):
     return (True, number)
 
 # Fermat primality test
-def FermatPrimalityTest(number):
+def FermatPrimalityTest(number, powmod=None):
     import random, math
+    if (powmod is None):
+        # passed in by 'primalityBatch', or chosen here for a single number
+        try:
+            from gmpy2 import powmod    # GMP modular exponentiation, where installed
+        except ImportError:
+            powmod = pow
 
     # if number != 1
     if (number > 1):
@@ -55,7 +68,7 @@ def FermatPrimalityTest(number):
             randomNumber = random.randint(2, number)-1
             
             # Test if a^(n-1) = 1 mod n
-            if ( pow(randomNumber, number-1, number) != 1 ):
+            if ( powmod(randomNumber, number-1, number) != 1 ):
                 return (False, number)
         
         return (True, number)
@@ -65,8 +78,14 @@ def FermatPrimalityTest(number):
 
 
 # Miller-Rabin primality test
-def MillerRabinPrimalityTest(number):
+def MillerRabinPrimalityTest(number, powmod=None):
     import random, math
+    if (powmod is None):
+        # passed in by 'primalityBatch', or chosen here for a single number
+        try:
+            from gmpy2 import powmod    # GMP modular exponentiation, where installed
+        except ImportError:
+            powmod = pow
     
     # because the algorithm input is ODD number than if we get
     # even and it is the number 2 we return TRUE ( spcial case )
@@ -83,13 +102,9 @@ def MillerRabinPrimalityTest(number):
     # the odd part of the number
     oddPartOfNumber = number - 1
     
-    # The number of time that the number is divided by two
-    timesTwoDividNumber = 0
-    
-    # while r is even divid by 2 to find the odd part
-    while oddPartOfNumber % 2 == 0:
-        oddPartOfNumber = oddPartOfNumber / 2
-        timesTwoDividNumber = timesTwoDividNumber + 1 
+    # strip the trailing zero bits to find the odd part, exactly
+    timesTwoDividNumber = (oddPartOfNumber & -oddPartOfNumber).bit_length() - 1
+    oddPartOfNumber = oddPartOfNumber >> timesTwoDividNumber
      
     
     # since there are number that are cases of "strong liar" we 
@@ -105,7 +120,7 @@ def MillerRabinPrimalityTest(number):
                 break
         
         # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-        randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
+        randomNumberWithPower = powmod(randomNumber, oddPartOfNumber, number)
         
         # if random number is not 1 and not -1 ( in mod n ) 
         if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
@@ -115,7 +130,7 @@ def MillerRabinPrimalityTest(number):
             # while we can squre the number and the squered number is not -1 mod number
             while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
                 # squre the number
-                randomNumberWithPower = pow(randomNumberWithPower, 2, number)
+                randomNumberWithPower = powmod(randomNumberWithPower, 2, number)
                 
                 # inc the number of iteration
                 iterationNumber = iterationNumber + 1
@@ -131,9 +146,303 @@ def MillerRabinPrimalityTest(number):
     return (True, number) 
 
 
+# product of the primes from 17 up to 'limit', so that 'smallPrimeFilter'
+# can screen a candidate against all of them with a single gcd
+def smallPrimorial(limit=1000):
+    primorial = 1
+    for p in range(17, limit, 2):
+        if all(p % q for q in range(3, int(p ** 0.5) + 1, 2)):
+            primorial *= p
+    return primorial
+
+# cheap screen in front of the modular exponentiation tests: trial division
+# by the primes below 17, then one gcd against 'primorial'. Returns False
+# if 'number' has a small factor, so is composite, and True if it still
+# needs a full test. 'counts' keeps the totals screened, rejected by trial
+# division, rejected by the gcd and passed on to the full test
+def smallPrimeFilter(number, primorial, counts):
+    import math
+
+    counts[0] += 1
+    if number < 1000:    # may be one of the small primes itself
+        counts[3] += 1
+        return True
+    for p in (2, 3, 5, 7, 11, 13):
+        if number % p == 0:
+            counts[1] += 1
+            return False
+    if math.gcd(number, primorial) != 1:
+        counts[2] += 1
+        return False
+    counts[3] += 1
+    return True
+
+
+# deterministic Miller-Rabin over a NumPy uint64 array of candidates,
+# vectorized so that thousands of candidates share each NumPy operation.
+# Products mod n use Montgomery multiplication, with the 128 bit product
+# built from 32 bit halves; returns a boolean mask of the primes
+def MillerRabinBatch(numbers):
+    import numpy
+
+    n = numpy.asarray(numbers, dtype=numpy.uint64)
+    low32 = numpy.uint64(0xffffffff)
+    shift32 = numpy.uint64(32)
+    zero, one = numpy.uint64(0), numpy.uint64(1)
+
+    # 64 x 64 -> 128 bit product as (high, low) halves
+    def mul128(a, b):
+        a0, a1 = a & low32, a >> shift32
+        b0, b1 = b & low32, b >> shift32
+        p00, p01, p10, p11 = a0 * b0, a0 * b1, a1 * b0, a1 * b1
+        mid = (p00 >> shift32) + (p01 & low32) + (p10 & low32)
+        low = (p00 & low32) | ((mid & low32) << shift32)
+        high = p11 + (p01 >> shift32) + (p10 >> shift32) + (mid >> shift32)
+        return high, low
+
+    # Montgomery product a * b / 2^64 mod modulus, for a, b < modulus,
+    # where nInverse is -1/modulus mod 2^64
+    def montMul(a, b, modulus, nInverse):
+        high, low = mul128(a, b)
+        m = low * nInverse    # wraps mod 2^64
+        mHigh, mLow = mul128(m, modulus)
+        # low + mLow is 0 mod 2^64, so it carries unless low is 0
+        t = high + (low != zero).astype(numpy.uint64)
+        s = t + mHigh
+        return numpy.where((s < t) | (s >= modulus), s - modulus, s)
+
+    # the small, even and tiny values are settled directly
+    result = numpy.zeros(n.shape, dtype=bool)
+    small = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+    for p in small:
+        result |= (n == numpy.uint64(p))
+    test = (n > numpy.uint64(37)) & ((n & one) == one)
+    if not test.any():
+        return result
+
+    # only the candidates still in the running are carried along, as
+    # indexes into 'n'
+    index = numpy.flatnonzero(test)
+    modulus = n[index]
+
+    # -1/modulus mod 2^64 by Newton's iteration, each step doubles the
+    # correct low bits starting from 3
+    inverse = modulus.copy()
+    for i in range(5):
+        inverse = inverse * (numpy.uint64(2) - modulus * inverse)
+    nInverse = zero - inverse
+
+    # 2^64 mod n is Montgomery's 1, and doubling it 64 times mod n gives
+    # 2^128 mod n to convert the bases into Montgomery form
+    montOne = (zero - modulus) % modulus
+    r2 = montOne.copy()
+    for i in range(64):
+        s = r2 + r2
+        r2 = numpy.where((s < r2) | (s >= modulus), s - modulus, s)
+
+    # below 2^32 a product fits in 64 bits, and plain % is quicker
+    mulMod = montMul
+    if int(modulus.max()) < 4294967296:
+        mulMod = lambda a, b, modulus, nInverse: a * b % modulus
+        montOne = numpy.ones(modulus.shape, dtype=numpy.uint64)
+        r2 = montOne.copy()
+
+    # modulus - 1 = oddPart * 2^twos, exactly
+    oddPart = modulus - one
+    twos = numpy.zeros(modulus.shape, dtype=numpy.uint64)
+    while True:
+        even = (oddPart & one) == zero
+        if not even.any():
+            break
+        oddPart = numpy.where(even, oddPart >> one, oddPart)
+        twos += even.astype(numpy.uint64)
+
+    # witness sets that are proven to have no strong liars below the limit
+    largest = int(modulus.max())
+    if largest < 3215031751:
+        witnesses = (2, 3, 5, 7)
+    elif largest < 341550071728321:
+        witnesses = (2, 3, 5, 7, 11, 13, 17)
+    else:
+        witnesses = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+
+    for a in witnesses:
+        base = numpy.uint64(a) % modulus
+        skip = base == zero    # a multiple of the modulus says nothing
+        base = mulMod(base, r2, modulus, nInverse)
+        montMinusOne = modulus - montOne
+
+        # x = base^oddPart mod n, right to left binary method
+        x = montOne.copy()
+        for bit in range(int(oddPart.max()).bit_length()):
+            odd = ((oddPart >> numpy.uint64(bit)) & one) == one
+            x = numpy.where(odd, mulMod(x, base, modulus, nInverse), x)
+            base = mulMod(base, base, modulus, nInverse)
+
+        passed = skip | (x == montOne) | (x == montMinusOne)
+        for r in range(1, int(twos.max())):
+            x = mulMod(x, x, modulus, nInverse)
+            passed |= (x == montMinusOne) & (numpy.uint64(r) < twos)
+
+        # most composites fail the first witness, so the later ones only
+        # see the survivors
+        index, modulus, nInverse = index[passed], modulus[passed], nInverse[passed]
+        montOne, r2, oddPart, twos = montOne[passed], r2[passed], oddPart[passed], twos[passed]
+        if (len(index) == 0):
+            break
+
+    result[index] = True
+    return result
+
+
+# test 'count' odd numbers from 'start' with the selected algorithm in a
+# single job, so that several numbers share the dispy overhead. Returns a
+# bit packed table in the same form as 'segmentedSieve', with bit k set
+# if start + 2 * k is prime, followed by the 'smallPrimeFilter' counts.
+def primalityBatch(primality, start, count):
+    tests = (naivePrimalityTest, FermatPrimalityTest, MillerRabinPrimalityTest)
+
+    # GMP arithmetic where installed, chosen once for the batch rather
+    # than by the test for every number
+    import math
+    try:
+        from gmpy2 import isqrt, powmod
+    except ImportError:
+        isqrt, powmod = math.isqrt, pow
+    arithmetic = (isqrt, powmod, powmod)[primality]
+
+    # Fermat and Miller-Rabin only see the numbers without a small factor
+    primorial = smallPrimorial()
+    counts = [0, 0, 0, 0]
+
+    # with NumPy, Miller-Rabin on 64 bit numbers runs over the whole batch
+    # at once in 'MillerRabinBatch'
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    vectorized = (primality == 2) and (numpy is not None) and (start + 2 * count < 18446744073709551616)
+    candidates = []
+
+    flags = bytearray(count)
+    for k in range(count):
+        number = start + 2 * k
+        if (primality in (1, 2)) and not smallPrimeFilter(number, primorial, counts):
+            continue
+        if vectorized:
+            candidates.append(number)
+            continue
+        isprime, number = tests[primality](number, arithmetic)
+        if (isprime):
+            flags[k] = 1
+
+    if vectorized and candidates:
+        mask = MillerRabinBatch(numpy.array(candidates, dtype=numpy.uint64))
+        for number in numpy.array(candidates, dtype=object)[mask]:
+            flags[(number - start) // 2] = 1
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'), tuple(counts))
+
+# segmented Sieve of Eratosthenes over the odd numbers start, start + 2,
+# ... (count of them, start odd). 'base' is a bit packed table of the odd
+# primes up to sqrt(upper_limit), computed once at the client, and the
+# sieve works through a buffer of 'segment' bytes so that it stays in
+# cache. Returns the same kind of bit packed table, with bit k set if
+# start + 2 * k is prime.
+def segmentedSieve(start, count, base, segment=262144):
+    import math
+
+    # unpack the base primes, skipping 1
+    primes = []
+    for i, byte in enumerate(base):
+        for bit in range(8):
+            if (byte >> bit) & 1:
+                primes.append(1 + 2 * (8 * i + bit))
+
+    zeros = bytes(segment)
+    flags = bytearray()
+
+    # sieve one cache sized segment of odd numbers at a time
+    low = start
+    end = start + 2 * count
+    while low < end:
+        size = min(segment, (end - low) // 2)
+        high = low + 2 * size
+        buf = bytearray(b'\x01') * size
+        limit = math.isqrt(high - 1)
+
+        for p in primes:
+            if p > limit:
+                break
+            # first odd multiple of p in this segment, but not below p*p
+            m = max(p * p, (low + p - 1) // p * p)
+            if (m % 2) == 0:
+                m += p
+            k = (m - low) // 2
+            if k < size:
+                buf[k::p] = zeros[:(size - 1 - k) // p + 1]
+
+        if low <= 1 < high:
+            buf[(1 - low) // 2] = 0    # 1 is not prime
+        flags += buf
+        low = high
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'))
+
+# bit packed table of the odd primes up to 'limit' in the same form as
+# the result of 'segmentedSieve', bit k is set if 1 + 2 * k is prime;
+# executed once at the client to give the base primes for every job
+def basePrimeTable(limit):
+    import math
+
+    count = (limit + 1) // 2
+    flags = bytearray(b'\x01') * count
+    flags[0] = 0    # 1 is not prime
+    for i in range(3, math.isqrt(limit) + 1, 2):
+        if flags[i // 2]:
+            flags[i * i // 2::i] = bytes(len(range(i * i // 2, count, i)))
+
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2)
+    return bits.to_bytes((count + 7) // 8, 'little')
+
+# list the primes in a bit packed table returned by 'segmentedSieve',
+# executed at the client
+def unpackPrimes(start, table):
+    primes = []
+    for i, byte in enumerate(table):
+        if byte:
+            for bit in range(8):
+                if (byte >> bit) & 1:
+                    primes.append(start + 2 * (8 * i + bit))
+    return primes
+
+
+# bit packed table for the odd numbers start, start + 2, ... (count of
+# them) read from the prime cache, in the same form as the job results,
+# or None if part of the range is not in the cache; executed at the client
+def cachedTable(cache, start, count):
+    end = start + 2 * (count - 1)
+    segments = range(cache.segment_of(start), cache.segment_of(end) + 1)
+    if any(cache.lookup(segment) is None for segment in segments):
+        return None
+
+    flags = bytearray(count)
+    for number in cache.primes_in_range(start, end):
+        flags[(number - start) // 2] = 1
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'))
+
+
 # main 
 if __name__ == '__main__':
-    import dispy, random, argparse, resource
+    import dispy, random, math, argparse, resource, collections, itertools, sys
+    import prime_file
 
     resource.setrlimit(resource.RLIMIT_STACK, (resource.RLIM_INFINITY, resource.RLIM_INFINITY) )
     resource.setrlimit(resource.RLIMIT_DATA, (resource.RLIM_INFINITY, resource.RLIM_INFINITY) )
@@ -141,16 +450,33 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("lower_limit", type=int, help="lowest putative prime to test")
     parser.add_argument("upper_limit", type =int, help="largest putative prime to test")
-    parser.add_argument("primality", type =int, help="algorithm to use; 0=naive, 1=Fermat, 2=Miller Rabin")
+    parser.add_argument("primality", type =int, help="algorithm to use; 0=naive, 1=Fermat, 2=Miller Rabin, 3=segmented sieve")
+    parser.add_argument("--batch", type=int, default=0, help="odd numbers tested by each job, returned as a bit table; 0 for one number per job")
+    parser.add_argument("--job-size", type=int, default=1048576, help="odd numbers sieved by each segmented sieve job")
+    parser.add_argument("--segment-size", type=int, default=262144, help="segmented sieve buffer in bytes, sized to fit in cache")
+    parser.add_argument("--cache", help="prime cache file; ranges already in it are not recomputed and sieved ranges are added to it")
+    parser.add_argument("--output", help="file the primes are written to in ascending order as the run goes; standard output if not given")
+    parser.add_argument("--binary", action="store_true", help="write --output in the compact prime list format of prime_file.py")
+    parser.add_argument("--window", type=int, default=96, help="jobs submitted ahead of the oldest unfinished one")
     args = parser.parse_args()
+    if args.binary and not args.output:
+        parser.error('--binary needs --output')
 
     lower_limit = args.lower_limit
     upper_limit = args.upper_limit
     primality = args.primality
+    batch = args.batch
+    job_size = args.job_size
+    segment_size = args.segment_size
     server_nodes ='192.168.1.*'
 
     # choose your algorthm
-    if (primality == 0):
+    tests = [naivePrimalityTest, FermatPrimalityTest, MillerRabinPrimalityTest, MillerRabinBatch, smallPrimorial, smallPrimeFilter]
+    if (batch > 0) and (primality < 3):
+       # the selected test runs inside 'primalityBatch' on the nodes
+       cluster = dispy.JobCluster(primalityBatch, depends=tests, nodes=server_nodes)
+       print(('%s primality test selected, tested in batches of %i' % (('Naive', 'Fermat', 'Miller-Rabin')[primality], batch)))
+    elif (primality == 0):
        cluster = dispy.JobCluster(naivePrimalityTest, nodes=server_nodes)
        print('Naive primality test selected')
     elif (primality == 1):
@@ -159,24 +485,112 @@ if __name__ == '__main__':
     elif (primality == 2):
        cluster = dispy.JobCluster(MillerRabinPrimalityTest, nodes=server_nodes)
        print('Miller-Rabin primality test selected')
+    elif (primality == 3):
+       cluster = dispy.JobCluster(segmentedSieve, nodes=server_nodes)
+       print('Segmented sieve selected')
 
     print(('Finding prime numbers in the range %i - %i on cluster %s' % (lower_limit, upper_limit, server_nodes)))
-    jobs = []
+
+    # jobs are submitted at most 'window' ahead of the oldest one, and the
+    # primes are written in ascending order as it finishes, so the client
+    # holds the same number of jobs however large the range is
+    jobs = collections.deque()
+    window = args.window
+    if args.binary:
+        output = prime_file.PrimeWriter(args.output)
+    else:
+        output = prime_file.TextPrimeWriter(open(args.output, 'w') if args.output else sys.stdout)
+
+    # Fermat and Miller-Rabin only run on numbers that get past the small
+    # prime prefilter, totals of the 'smallPrimeFilter' counts from all jobs
+    prefilter = primality in (1, 2)
+    prefilter_counts = [0, 0, 0, 0]
 
     if lower_limit % 2 == 0:    # make sure we start with an odd number
         lower_limit += 1 
 
-    for i in range(lower_limit, upper_limit, 2):
-        # schedule execution of desired primality test on a node (running 'dispynode')
-        job = cluster.submit(i)
-        job.id = i # associate an ID to the job
-        jobs.append(job)
+    # with --cache, ranges already in the prime cache are read from it
+    # instead of being submitted, and the sieve works in whole segments
+    # of the cache so that its results can be added to it
+    cache = None
+    first, last = lower_limit, upper_limit
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache)
+        if (primality == 3):
+            job_size = cache.segment_size
+            first = cache.segment_start(cache.segment_of(lower_limit))
+            last = cache.segment_start(cache.segment_of(upper_limit) + 1) - 2
 
-    for job in jobs:
-        isprime, number = job() # waits for job to finish and returns results
+    if (primality == 3) or (batch > 0):
+        if (primality == 3):
+            # the base primes up to sqrt(upper_limit) are found once, here
+            base = basePrimeTable(math.isqrt(last) + 1)
+        else:
+            job_size = batch
 
-        if (isprime):
-            print(number)
+        # each job covers a contiguous block of odd numbers; None marks
+        # the end of the range, where the remaining jobs are written out
+        for i in itertools.chain(range(first, upper_limit, 2 * job_size), [None]):
+            if (i is not None):
+                count = min(job_size, (last - i) // 2 + 1)
+                cached = cachedTable(cache, i, count) if (cache is not None) else None
+                if (cached is not None):
+                    jobs.append(cached)    # already a result
+                else:
+                    if (primality == 3):
+                        job = cluster.submit(i, count, base, segment_size)
+                    else:
+                        job = cluster.submit(primality, i, count)
+                    job.id = i # associate an ID to the job
+                    jobs.append(job)
+
+            while jobs and ((len(jobs) >= window) or (i is None)):
+                job = jobs.popleft()
+                if isinstance(job, tuple):
+                    result = job
+                else:
+                    result = job() # waits for job to finish and returns results
+                    # only a job that sieved a whole segment can be stored
+                    if (cache is not None) and (primality == 3) and (result[1] == cache.segment_size):
+                        cache.store(cache.segment_of(job.id), result[2])
+                start, count, table = result[:3]
+                if (len(result) > 3):
+                    prefilter_counts = [a + b for a, b in zip(prefilter_counts, result[3])]
+
+                for number in unpackPrimes(start, table):
+                    if (lower_limit <= number <= upper_limit):
+                        output.write(number)
+                output.flush()
+    else:
+        # numbers with a small factor are rejected here and never submitted
+        primorial = smallPrimorial()
+        for i in itertools.chain(range(lower_limit, upper_limit, 2), [None]):
+            if (i is None):
+                pass
+            elif (cache is not None) and (cache.lookup(cache.segment_of(i)) is not None):
+                jobs.append((cache.is_prime(i), i))    # already a result
+            elif (not prefilter) or smallPrimeFilter(i, primorial, prefilter_counts):
+                # schedule execution of desired primality test on a node (running 'dispynode')
+                job = cluster.submit(i)
+                job.id = i # associate an ID to the job
+                jobs.append(job)
+
+            while jobs and ((len(jobs) >= window) or (i is None)):
+                job = jobs.popleft()
+                if isinstance(job, tuple):
+                    isprime, number = job
+                else:
+                    isprime, number = job() # waits for job to finish and returns results
+
+                if (isprime):
+                    output.write(number)
+                    output.flush()
+
+    output.close()
+
+    if prefilter:
+        print(('small prime prefilter: %i screened, %i rejected by trial division, %i rejected by gcd, %i passed to the full test' % tuple(prefilter_counts)))
 
     cluster.print_status()
     cluster.close()
@@ -30,8 +30,15 @@
 # All other original code: Crown Copyright 2016, 2017 
 
 # naive primality test
-def naivePrimalityTest(number):
+def naivePrimalityTest(number, isqrt=None):
     import math
+    if (isqrt is None):
+        # a job of one number chooses here, 'primalityBatch' chooses once
+        # for a whole batch and passes it in
+        try:
+            from gmpy2 import isqrt    # GMP arithmetic, where installed
+        except ImportError:
+            isqrt = math.isqrt
 
     if number == 2:  # obvious special case
        return (True, number)
@@ -39,7 +46,7 @@ def naivePrimalityTest(number):
         return (False, number)
     
     i = 3
-    sqrtOfNumber = math.sqrt(number)
+    sqrtOfNumber = isqrt(number)
     
     while i <= sqrtOfNumber:
         if number % i == 0:
@@ -49,8 +56,14 @@ def naivePrimalityTest(number):
     return (True, number)
 
 # Fermat primality test
-def FermatPrimalityTest(number):
+def FermatPrimalityTest(number, powmod=None):
     import random, math
+    if (powmod is None):
+        # passed in by 'primalityBatch', or chosen here for a single number
+        try:
+            from gmpy2 import powmod    # GMP modular exponentiation, where installed
+        except ImportError:
+            powmod = pow
 
     # if number != 1
     if (number > 1):
@@ -60,7 +73,7 @@ def FermatPrimalityTest(number):
             randomNumber = random.randint(2, number)-1
             
             # Test if a^(n-1) = 1 mod n
-            if ( pow(randomNumber, number-1, number) != 1 ):
+            if ( powmod(randomNumber, number-1, number) != 1 ):
                 return (False, number)
         
         return (True, number)
@@ -70,8 +83,14 @@ def FermatPrimalityTest(number):
 
 
 # Miller-Rabin primality test
-def MillerRabinPrimalityTest(number):
+def MillerRabinPrimalityTest(number, powmod=None):
     import random, math
+    if (powmod is None):
+        # passed in by 'primalityBatch', or chosen here for a single number
+        try:
+            from gmpy2 import powmod    # GMP modular exponentiation, where installed
+        except ImportError:
+            powmod = pow
     
     # because the algorithm input is ODD number than if we get
     # even and it is the number 2 we return TRUE ( spcial case )
@@ -88,13 +107,9 @@ def MillerRabinPrimalityTest(number):
     # the odd part of the number
     oddPartOfNumber = number - 1
     
-    # The number of time that the number is divided by two
-    timesTwoDividNumber = 0
-    
-    # while r is even divid by 2 to find the odd part
-    while oddPartOfNumber % 2 == 0:
-        oddPartOfNumber = oddPartOfNumber / 2
-        timesTwoDividNumber = timesTwoDividNumber + 1 
+    # strip the trailing zero bits to find the odd part, exactly
+    timesTwoDividNumber = (oddPartOfNumber & -oddPartOfNumber).bit_length() - 1
+    oddPartOfNumber = oddPartOfNumber >> timesTwoDividNumber
      
     
     # since there are number that are cases of "strong liar" we 
@@ -110,7 +125,7 @@ def MillerRabinPrimalityTest(number):
                 break
         
         # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-        randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
+        randomNumberWithPower = powmod(randomNumber, oddPartOfNumber, number)
         
         # if random number is not 1 and not -1 ( in mod n ) 
         if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
@@ -120,7 +135,7 @@ def MillerRabinPrimalityTest(number):
             # while we can squre the number and the squered number is not -1 mod number
             while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
                 # squre the number
-                randomNumberWithPower = pow(randomNumberWithPower, 2, number)
+                randomNumberWithPower = powmod(randomNumberWithPower, 2, number)
                 
                 # inc the number of iteration
                 iterationNumber = iterationNumber + 1
@@ -136,10 +151,435 @@ def MillerRabinPrimalityTest(number):
     return (True, number) 
 
 
+# product of the primes from 17 up to 'limit', so that 'smallPrimeFilter'
+# can screen a candidate against all of them with a single gcd
+def smallPrimorial(limit=1000):
+    primorial = 1
+    for p in range(17, limit, 2):
+        if all(p % q for q in range(3, int(p ** 0.5) + 1, 2)):
+            primorial *= p
+    return primorial
+
+# cheap screen in front of the modular exponentiation tests: trial division
+# by the primes below 17, then one gcd against 'primorial'. Returns False
+# if 'number' has a small factor, so is composite, and True if it still
+# needs a full test. 'counts' keeps the totals screened, rejected by trial
+# division, rejected by the gcd and passed on to the full test
+def smallPrimeFilter(number, primorial, counts):
+    import math
+
+    counts[0] += 1
+    if number < 1000:    # may be one of the small primes itself
+        counts[3] += 1
+        return True
+    for p in (2, 3, 5, 7, 11, 13):
+        if number % p == 0:
+            counts[1] += 1
+            return False
+    if math.gcd(number, primorial) != 1:
+        counts[2] += 1
+        return False
+    counts[3] += 1
+    return True
+
+
+# deterministic Miller-Rabin over a NumPy uint64 array of candidates,
+# vectorized so that thousands of candidates share each NumPy operation.
+# Products mod n use Montgomery multiplication, with the 128 bit product
+# built from 32 bit halves; returns a boolean mask of the primes
+def MillerRabinBatch(numbers):
+    import numpy
+
+    n = numpy.asarray(numbers, dtype=numpy.uint64)
+    low32 = numpy.uint64(0xffffffff)
+    shift32 = numpy.uint64(32)
+    zero, one = numpy.uint64(0), numpy.uint64(1)
+
+    # 64 x 64 -> 128 bit product as (high, low) halves
+    def mul128(a, b):
+        a0, a1 = a & low32, a >> shift32
+        b0, b1 = b & low32, b >> shift32
+        p00, p01, p10, p11 = a0 * b0, a0 * b1, a1 * b0, a1 * b1
+        mid = (p00 >> shift32) + (p01 & low32) + (p10 & low32)
+        low = (p00 & low32) | ((mid & low32) << shift32)
+        high = p11 + (p01 >> shift32) + (p10 >> shift32) + (mid >> shift32)
+        return high, low
+
+    # Montgomery product a * b / 2^64 mod modulus, for a, b < modulus,
+    # where nInverse is -1/modulus mod 2^64
+    def montMul(a, b, modulus, nInverse):
+        high, low = mul128(a, b)
+        m = low * nInverse    # wraps mod 2^64
+        mHigh, mLow = mul128(m, modulus)
+        # low + mLow is 0 mod 2^64, so it carries unless low is 0
+        t = high + (low != zero).astype(numpy.uint64)
+        s = t + mHigh
+        return numpy.where((s < t) | (s >= modulus), s - modulus, s)
+
+    # the small, even and tiny values are settled directly
+    result = numpy.zeros(n.shape, dtype=bool)
+    small = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+    for p in small:
+        result |= (n == numpy.uint64(p))
+    test = (n > numpy.uint64(37)) & ((n & one) == one)
+    if not test.any():
+        return result
+
+    # only the candidates still in the running are carried along, as
+    # indexes into 'n'
+    index = numpy.flatnonzero(test)
+    modulus = n[index]
+
+    # -1/modulus mod 2^64 by Newton's iteration, each step doubles the
+    # correct low bits starting from 3
+    inverse = modulus.copy()
+    for i in range(5):
+        inverse = inverse * (numpy.uint64(2) - modulus * inverse)
+    nInverse = zero - inverse
+
+    # 2^64 mod n is Montgomery's 1, and doubling it 64 times mod n gives
+    # 2^128 mod n to convert the bases into Montgomery form
+    montOne = (zero - modulus) % modulus
+    r2 = montOne.copy()
+    for i in range(64):
+        s = r2 + r2
+        r2 = numpy.where((s < r2) | (s >= modulus), s - modulus, s)
+
+    # below 2^32 a product fits in 64 bits, and plain % is quicker
+    mulMod = montMul
+    if int(modulus.max()) < 4294967296:
+        mulMod = lambda a, b, modulus, nInverse: a * b % modulus
+        montOne = numpy.ones(modulus.shape, dtype=numpy.uint64)
+        r2 = montOne.copy()
+
+    # modulus - 1 = oddPart * 2^twos, exactly
+    oddPart = modulus - one
+    twos = numpy.zeros(modulus.shape, dtype=numpy.uint64)
+    while True:
+        even = (oddPart & one) == zero
+        if not even.any():
+            break
+        oddPart = numpy.where(even, oddPart >> one, oddPart)
+        twos += even.astype(numpy.uint64)
+
+    # witness sets that are proven to have no strong liars below the limit
+    largest = int(modulus.max())
+    if largest < 3215031751:
+        witnesses = (2, 3, 5, 7)
+    elif largest < 341550071728321:
+        witnesses = (2, 3, 5, 7, 11, 13, 17)
+    else:
+        witnesses = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+
+    for a in witnesses:
+        base = numpy.uint64(a) % modulus
+        skip = base == zero    # a multiple of the modulus says nothing
+        base = mulMod(base, r2, modulus, nInverse)
+        montMinusOne = modulus - montOne
+
+        # x = base^oddPart mod n, right to left binary method
+        x = montOne.copy()
+        for bit in range(int(oddPart.max()).bit_length()):
+            odd = ((oddPart >> numpy.uint64(bit)) & one) == one
+            x = numpy.where(odd, mulMod(x, base, modulus, nInverse), x)
+            base = mulMod(base, base, modulus, nInverse)
+
+        passed = skip | (x == montOne) | (x == montMinusOne)
+        for r in range(1, int(twos.max())):
+            x = mulMod(x, x, modulus, nInverse)
+            passed |= (x == montMinusOne) & (numpy.uint64(r) < twos)
+
+        # most composites fail the first witness, so the later ones only
+        # see the survivors
+        index, modulus, nInverse = index[passed], modulus[passed], nInverse[passed]
+        montOne, r2, oddPart, twos = montOne[passed], r2[passed], oddPart[passed], twos[passed]
+        if (len(index) == 0):
+            break
+
+    result[index] = True
+    return result
+
+
+# test 'count' odd numbers from 'start' with the selected algorithm in a
+# single job, so that several numbers share the dispy overhead. Returns a
+# bit packed table in the same form as 'segmentedSieve', with bit k set
+# if start + 2 * k is prime, followed by the 'smallPrimeFilter' counts.
+def primalityBatch(primality, start, count):
+    tests = (naivePrimalityTest, FermatPrimalityTest, MillerRabinPrimalityTest)
+
+    # GMP arithmetic where installed, chosen once for the batch rather
+    # than by the test for every number
+    import math
+    try:
+        from gmpy2 import isqrt, powmod
+    except ImportError:
+        isqrt, powmod = math.isqrt, pow
+    arithmetic = (isqrt, powmod, powmod)[primality]
+
+    # Fermat and Miller-Rabin only see the numbers without a small factor
+    primorial = smallPrimorial()
+    counts = [0, 0, 0, 0]
+
+    # with NumPy, Miller-Rabin on 64 bit numbers runs over the whole batch
+    # at once in 'MillerRabinBatch'
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    vectorized = (primality == 2) and (numpy is not None) and (start + 2 * count < 18446744073709551616)
+    candidates = []
+
+    flags = bytearray(count)
+    for k in range(count):
+        number = start + 2 * k
+        if (primality in (1, 2)) and not smallPrimeFilter(number, primorial, counts):
+            continue
+        if vectorized:
+            candidates.append(number)
+            continue
+        isprime, number = tests[primality](number, arithmetic)
+        if (isprime):
+            flags[k] = 1
+
+    if vectorized and candidates:
+        mask = MillerRabinBatch(numpy.array(candidates, dtype=numpy.uint64))
+        for number in numpy.array(candidates, dtype=object)[mask]:
+            flags[(number - start) // 2] = 1
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'), tuple(counts))
+
+
+# segmented Sieve of Eratosthenes over the odd numbers start, start + 2,
+# ... (count of them, start odd). 'base' is a bit packed table of the odd
+# primes up to sqrt(upper_limit), computed once at the client, and the
+# sieve works through a buffer of 'segment' bytes so that it stays in
+# cache. Returns the same kind of bit packed table, with bit k set if
+# start + 2 * k is prime.
+def segmentedSieve(start, count, base, segment=262144):
+    import math
+
+    # unpack the base primes, skipping 1
+    primes = []
+    for i, byte in enumerate(base):
+        for bit in range(8):
+            if (byte >> bit) & 1:
+                primes.append(1 + 2 * (8 * i + bit))
+
+    zeros = bytes(segment)
+    flags = bytearray()
+
+    # sieve one cache sized segment of odd numbers at a time
+    low = start
+    end = start + 2 * count
+    while low < end:
+        size = min(segment, (end - low) // 2)
+        high = low + 2 * size
+        buf = bytearray(b'\x01') * size
+        limit = math.isqrt(high - 1)
+
+        for p in primes:
+            if p > limit:
+                break
+            # first odd multiple of p in this segment, but not below p*p
+            m = max(p * p, (low + p - 1) // p * p)
+            if (m % 2) == 0:
+                m += p
+            k = (m - low) // 2
+            if k < size:
+                buf[k::p] = zeros[:(size - 1 - k) // p + 1]
+
+        if low <= 1 < high:
+            buf[(1 - low) // 2] = 0    # 1 is not prime
+        flags += buf
+        low = high
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'))
+
+# bit packed table of the odd primes up to 'limit' in the same form as
+# the result of 'segmentedSieve', bit k is set if 1 + 2 * k is prime;
+# executed once at the client to give the base primes for every job
+def basePrimeTable(limit):
+    import math
+
+    count = (limit + 1) // 2
+    flags = bytearray(b'\x01') * count
+    flags[0] = 0    # 1 is not prime
+    for i in range(3, math.isqrt(limit) + 1, 2):
+        if flags[i // 2]:
+            flags[i * i // 2::i] = bytes(len(range(i * i // 2, count, i)))
+
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2)
+    return bits.to_bytes((count + 7) // 8, 'little')
+
+# list the primes in a bit packed table returned by 'segmentedSieve',
+# executed at the client
+def unpackPrimes(start, table):
+    primes = []
+    for i, byte in enumerate(table):
+        if byte:
+            for bit in range(8):
+                if (byte >> bit) & 1:
+                    primes.append(start + 2 * (8 * i + bit))
+    return primes
+
+
+# bit packed table for the odd numbers start, start + 2, ... (count of
+# them) read from the prime cache, in the same form as the job results,
+# or None if part of the range is not in the cache; executed at the client
+def cachedTable(cache, start, count):
+    end = start + 2 * (count - 1)
+    segments = range(cache.segment_of(start), cache.segment_of(end) + 1)
+    if any(cache.lookup(segment) is None for segment in segments):
+        return None
+
+    flags = bytearray(count)
+    for number in cache.primes_in_range(start, end):
+        flags[(number - start) // 2] = 1
+
+    # pack one flag per bit, bit k of the result is flags[k]
+    bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2) if flags else 0
+    return (start, count, bits.to_bytes((count + 7) // 8, 'little'))
+
+
+# the first 'tune_jobs' jobs are timed, and later jobs sized from them to
+# take about 'target_duration' seconds (see job_tuning.py); executed at
+# the client with 'jobs_cond' held
+def tune_granularity(job, size):
+    global granularity, tune_overhead, tune_cost
+
+    if (len(tune_samples) >= tune_jobs) or (job.start_time is None) or (job.end_time is None):
+        return
+    tune_samples.append((size, max(job.end_time - job.start_time, 1e-6)))
+    tune_overhead, tune_cost = job_tuning.fit_job_time(tune_samples)
+    granularity = job_tuning.target_size(size, tune_overhead, tune_cost, target_duration)
+
+# results leave through a reorder buffer: each job's primes wait in
+# 'reorder' until every job submitted before it has been written, so the
+# output is in ascending order; executed at the client with 'jobs_cond'
+# held
+def write_in_order():
+    global written_upto, primes_written
+
+    while job_order and (job_order[0] in reorder):
+        job_id = job_order.popleft()
+        written_upto = job_last.pop(job_id) + 2
+        job_counts.pop(job_id, None)
+        primes_written += len(reorder[job_id])
+        for number in reorder.pop(job_id):
+            if output is not None:
+                output.write(number)
+            else:
+                dispy.logger.info('job "%i" returned %i, %s jobs pending', job_id, number, len(pending_jobs))
+    if output is not None:
+        output.flush()    # usable while the run is in progress
+
+# put the primes from a finished job into the reorder buffer; executed at
+# the client with 'jobs_cond' held, by 'job_callback' or by 'main' for a
+# job that finished before 'main' assigned its id
+def collect_result(job):
+    global prefilter_counts
+
+    if (job.id in reorder) or (not job_order) or (job.id < job_order[0]):
+        return    # collected already
+    size = job_sizes.pop(job.id)
+
+    # a job that failed has no result, so its range keeps its place in the
+    # order and is submitted again by 'main', rather than being written as
+    # having no primes
+    if (job.status != dispy.DispyJob.Finished):
+        if stopped:
+            return    # cancelled as the run stops
+        failed.append((job.id, size))
+        dispy.logger.warning('job "%i" failed (status %s), to be submitted again', job.id, job.status)
+        return
+
+    primes = []
+    if batched:
+        start, count, table = job.result[:3] # returns results from job
+        if (primality != 3):
+            prefilter_counts = [a + b for a, b in zip(prefilter_counts, job.result[3])]
+            job_counts[job.id] = job.result[3]
+        elif (cache is not None) and (count == cache.segment_size):
+            # only a job that sieved a whole segment can be stored
+            cache.store(cache.segment_of(start), table)
+        # whole cache segments are sieved, so trim to the range
+        primes = [number for number in unpackPrimes(start, table) if lower_limit <= number <= upper_limit]
+        if auto_tune:
+            tune_granularity(job, size)
+    else:
+        isprime, number = job.result # returns results from job
+        if (isprime == True):
+            primes = [number]
+
+    reorder[job.id] = primes
+    write_in_order()
+
+# submit the job for the odd numbers start, start + 2, ... (size of them)
+# to a node (running 'dispynode'), its range already in 'job_order';
+# executed at the client by 'main', not holding 'jobs_cond'
+def submit_range(start, size):
+    if (primality == 3):
+        job = cluster.submit(start, size, base, segment_size)
+    elif batched:
+        job = cluster.submit(primality, start, size)
+    else:
+        job = cluster.submit(start)
+
+    jobs_cond.acquire()
+    job.id = start # associate an ID to the job
+    job_sizes[start] = size
+
+    # there is a chance the job may have finished and job_callback called by
+    # this time, so put it in 'pending_jobs' only if job is pending, and
+    # otherwise collect its result here
+    if job.status == dispy.DispyJob.Created or job.status == dispy.DispyJob.Running:
+        pending_jobs[start] = job
+        # dispy.logger.info('job "%s" submitted: %s', start, len(pending_jobs))
+    else:
+        collect_result(job)
+    jobs_cond.release()
+
+# submit the ranges whose jobs failed again; the output waits for them,
+# so a range that has failed 'max_attempts' times stops the run instead
+# of leaving a gap, and returns False; executed at the client by 'main'
+def resubmit_failed():
+    jobs_cond.acquire()
+    retry = list(failed)
+    failed.clear()
+    jobs_cond.release()
+    for start, size in retry:
+        attempts[start] = attempts.get(start, 1) + 1
+        if (attempts[start] > max_attempts):
+            dispy.logger.error('job "%i" failed %i times, stopping at %i', start, max_attempts, written_upto)
+            return False
+        submit_range(start, size)
+    return True
+
+# save the progress to the --checkpoint file, once its interval has passed
+# or when 'force' is set: as the primes are written in order, the numbers
+# done are those below 'written_upto', with the output file synced to
+# match, and the jobs in flight are those still in the reorder buffer,
+# whose prefilter counts are left out as they will be run again;
+# executed at the client with 'jobs_cond' held
+def save_checkpoint(force=False):
+    if (saver is None) or not (force or saver.due()):
+        return
+    counts = prefilter_counts
+    for job_id in job_counts:
+        counts = [a - b for a, b in zip(counts, job_counts[job_id])]
+    saver.save({'lower_limit': lower_limit, 'upper_limit': upper_limit, 'primality': primality,
+                'done': [[first, written_upto - 2]] if (written_upto > first) else [],
+                'in_flight': [[job_id, job_last[job_id]] for job_id in job_order],
+                'primes_written': primes_written, 'output_offset': output.sync() if (output is not None) else None,
+                'prefilter_counts': counts, 'granularity': granularity})
+
 # dispy calls this function to indicate change in job status
 def job_callback(job): # executed at the client
     global pending_jobs, jobs_cond
-    global total_inside
 
     if (job.status == dispy.DispyJob.Finished  # most usual case
         or job.status in (dispy.DispyJob.Terminated, dispy.DispyJob.Cancelled,
@@ -148,21 +588,23 @@ def job_callback(job): # executed at the client
         # 'jobs_cond' (see below)
         jobs_cond.acquire()
         if job.id: # job may have finished before 'main' assigned id
-            pending_jobs.pop(job.id)
+            pending_jobs.pop(job.id, None)
 
             # extract the results for each job as it happens
-            primality, number = job.result # returns results from job
-            if (primality == True):
-                dispy.logger.info('job "%i" returned %s, %s jobs pending', job.id, primality, len(pending_jobs))
+            collect_result(job)
+            save_checkpoint()
 
-            if len(pending_jobs) <= lower_bound:
+            # jobs waiting in the reorder buffer count against the bound
+            # too; a failed job has to be submitted again
+            if (len(job_order) <= lower_bound) or failed:
                 jobs_cond.notify()
         jobs_cond.release()
 
 
 # main 
 if __name__ == '__main__':
-    import dispy, random, argparse, resource, threading, logging
+    import dispy, random, math, argparse, resource, threading, logging, collections
+    import prime_file, checkpoint, job_tuning, os
 
     # set lower and upper bounds as appropriate
     # lower_bound is at least num of cpus and upper_bound is roughly 3x lower_bound
@@ -175,20 +617,63 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("lower_limit", type=int, help="lowest putative prime to test")
     parser.add_argument("upper_limit", type =int, help="largest putative prime to test")
-    parser.add_argument("primality", type =int, help="algorithm to use; 0=naive, 1=Fermat, 2=Miller Rabin")
+    parser.add_argument("primality", type =int, help="algorithm to use; 0=naive, 1=Fermat, 2=Miller Rabin, 3=segmented sieve")
+    parser.add_argument("--job-size", type=int, default=1048576, help="odd numbers sieved by each segmented sieve job (the first jobs with --auto-tune)")
+    parser.add_argument("--segment-size", type=int, default=262144, help="segmented sieve buffer in bytes, sized to fit in cache")
+    parser.add_argument("--cache", help="prime cache file; ranges already in it are not recomputed and sieved ranges are added to it")
+    parser.add_argument("--batch", type=int, default=0, help="odd numbers tested by each job, returned as a bit table; 0 for one number per job")
+    parser.add_argument("--auto-tune", action="store_true", help="pack several numbers into each job, sized to take about --target-duration seconds")
+    parser.add_argument("--target-duration", type=float, default=3.0, help="job duration in seconds aimed for by --auto-tune")
+    parser.add_argument("--output", help="file the primes are written to in ascending order as the run goes; logged if not given")
+    parser.add_argument("--binary", action="store_true", help="write --output in the compact prime list format of prime_file.py")
+    parser.add_argument("--checkpoint", help="file the progress is saved to as the run goes")
+    parser.add_argument("--checkpoint-interval", type=float, default=60.0, help="seconds between saves of --checkpoint")
+    parser.add_argument("--resume", action="store_true", help="carry on from --checkpoint, appending to --output, and submit only the ranges not done yet")
     args = parser.parse_args()
+    if args.binary and not args.output:
+        parser.error('--binary needs --output')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint')
+    if args.checkpoint and (not args.resume) and os.path.exists(args.checkpoint):
+        parser.error('%s exists, add --resume to carry on from it' % args.checkpoint)
+
+    # a resumed run has to be the same search, writing to the same output
+    state = None
+    if args.resume:
+        state = checkpoint.load(args.checkpoint)
+        if (state['lower_limit'], state['upper_limit'], state['primality']) != (args.lower_limit, args.upper_limit, args.primality):
+            parser.error('%s is the checkpoint of a search of %i - %i with primality %i' % (args.checkpoint, state['lower_limit'], state['upper_limit'], state['primality']))
+        if (state['output_offset'] is None) != (args.output is None):
+            parser.error('%s was saved by a run %s --output' % (args.checkpoint, 'without' if (state['output_offset'] is None) else 'with'))
 
     lower_limit = args.lower_limit
     upper_limit = args.upper_limit
     primality = args.primality
+    job_size = args.job_size
+    segment_size = args.segment_size
+    batch = args.batch
+    auto_tune = args.auto_tune
+    target_duration = args.target_duration
     server_nodes ='192.168.1.*'
 
     # use Condition variable to protect access to pending_jobs, as
     # 'job_callback' is executed in another thread
     jobs_cond = threading.Condition()
 
+    # jobs cover a range of numbers and return a bit table, except for
+    # the plain tests without --batch or --auto-tune
+    batched = (primality == 3) or (batch > 0) or auto_tune
+
     # choose your algorthm
-    if (primality == 0):
+    tests = [naivePrimalityTest, FermatPrimalityTest, MillerRabinPrimalityTest, MillerRabinBatch, smallPrimorial, smallPrimeFilter]
+    if (primality == 3):
+       cluster = dispy.JobCluster(segmentedSieve, nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+       print('Segmented sieve selected')
+    elif batched:
+       # the selected test runs inside 'primalityBatch' on the nodes
+       cluster = dispy.JobCluster(primalityBatch, depends=tests, nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
+       print(('%s primality test selected, tested in batches' % ('Naive', 'Fermat', 'Miller-Rabin')[primality]))
+    elif (primality == 0):
        cluster = dispy.JobCluster(naivePrimalityTest, nodes=server_nodes, callback=job_callback, loglevel=logging.INFO)
        print('Naive primality test selected')
     elif (primality == 1):
@@ -200,32 +685,169 @@ if __name__ == '__main__':
 
     pending_jobs = {}
 
-    print(('Finding prime numbers in the range %i - %i on cluster %s' % (lower_limit, upper_limit, server_nodes)))
-    i = lower_limit
+    # job ids (their first number) in submission order, until their primes
+    # are written, and the primes of those that finished out of order
+    job_order = collections.deque()
+    reorder = {}
+    output = None
+    if args.binary:
+        output = prime_file.PrimeWriter(args.output, offset=state['output_offset'] if state else None)
+    elif args.output and state:
+        # drop anything written after the checkpoint, and carry on from it
+        f = open(args.output, 'r+')
+        f.truncate(state['output_offset'])
+        f.seek(state['output_offset'])
+        output = prime_file.TextPrimeWriter(f)
+    elif args.output:
+        output = prime_file.TextPrimeWriter(open(args.output, 'w'))
+
+    # the job size starts at --batch numbers (16 if not given, or
+    # --job-size for the sieve), and the tuner moves it while the first
+    # jobs finish
+    granularity = batch or 16
+    i, last = lower_limit, upper_limit
     if i % 2 == 0:    # make sure we start with an odd number
         i += 1 
 
+    # with --cache, ranges already in the prime cache are read from it
+    # instead of being submitted, and the sieve works in whole segments
+    # of the cache so that its results can be added to it; 'job_callback'
+    # uses the cache too, so it is only used with 'jobs_cond' held
+    cache = None
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache)
+        if (primality == 3):
+            job_size = cache.segment_size
+            i = cache.segment_start(cache.segment_of(i))
+            last = cache.segment_start(cache.segment_of(upper_limit) + 1) - 2
+            if auto_tune:
+                print('Sieve jobs are whole cache segments, --auto-tune ignored')
+                auto_tune = False
+
+    if (primality == 3):
+        granularity = job_size
+
+        # the base primes up to sqrt(upper_limit) are found once, here
+        base = basePrimeTable(math.isqrt(last) + 1)
+    tune_jobs = 4 * upper_bound
+    tune_samples = []
+    tune_overhead, tune_cost = 0.0, 0.0
+    job_sizes = {}
+
+    # Fermat and Miller-Rabin only run on numbers that get past the small
+    # prime prefilter, totals of the 'smallPrimeFilter' counts from all jobs
+    prefilter = primality in (1, 2)
+    prefilter_counts = [0, 0, 0, 0]
+    primorial = smallPrimorial()
+
+    # with --checkpoint the progress is saved as the jobs finish, and with
+    # --resume the run carries on from the first number not written yet;
+    # the jobs that were in flight start from there, so they are the first
+    # ones submitted again
+    first = i
+    written_upto = i    # every number below it is done and written
+    job_last = {}    # last number of each job in the reorder buffer, by id
+    job_counts = {}    # and the prefilter counts of those that have them
+    primes_written = 0
+    saver = None
+    if args.checkpoint:
+        saver = checkpoint.Checkpoint(args.checkpoint, args.checkpoint_interval)
+    if state:
+        if state['done']:
+            i = written_upto = state['done'][0][1] + 2
+        primes_written = state['primes_written']
+        prefilter_counts = state['prefilter_counts']
+        if auto_tune:
+            granularity = state['granularity']
+        print(('Resuming from %s at %i: %i primes written, %i jobs that were in flight resubmitted' % (args.checkpoint, i, primes_written, len(state['in_flight']))))
+
+    # ranges whose jobs failed, to be submitted again, and the attempts
+    # made at each of them
+    failed = collections.deque()
+    attempts = {}
+    max_attempts = 3
+    stopped = False
+
+    print(('Finding prime numbers in the range %i - %i on cluster %s' % (lower_limit, upper_limit, server_nodes)))
+
     while i <= upper_limit:
-        # schedule execution of desired primality test on a node (running 'dispynode')
-        job = cluster.submit(i)
+        if failed and not resubmit_failed():
+            stopped = True
+            break
 
+        size = min(granularity, (last - i) // 2 + 1) if batched else 1
+
+        # ranges in the prime cache need no job
+        if (cache is not None):
+            jobs_cond.acquire()
+            cached = cachedTable(cache, i, size)
+            if (cached is not None):
+                job_order.append(i)
+                job_last[i] = i + 2 * (size - 1)
+                reorder[i] = [number for number in unpackPrimes(cached[0], cached[2]) if lower_limit <= number <= upper_limit]
+                write_in_order()
+                save_checkpoint()
+            jobs_cond.release()
+            if (cached is not None):
+                i += 2 * size
+                continue
+
+        if (not batched) and prefilter and not smallPrimeFilter(i, primorial, prefilter_counts):
+            # a small factor, so not worth a job
+            i += 2
+            continue
+
+        # schedule execution of desired primality test on a node (running 'dispynode')
         jobs_cond.acquire()
+        job_order.append(i)
+        job_last[i] = i + 2 * (size - 1)
+        jobs_cond.release()
+        submit_range(i, size)
 
-        job.id = i # associate an ID to the job
+        jobs_cond.acquire()
 
-        # there is a chance the job may have finished and job_callback called by
-        # this time, so put it in 'pending_jobs' only if job is pending
-        if job.status == dispy.DispyJob.Created or job.status == dispy.DispyJob.Running:
-            pending_jobs[i] = job
-            # dispy.logger.info('job "%s" submitted: %s', i, len(pending_jobs))
-            if len(pending_jobs) >= upper_bound:
-                while len(pending_jobs) > lower_bound:
-                    jobs_cond.wait()
+        # the jobs held in the reorder buffer count against the bound as well,
+        # so a slow job holds back submission rather than growing the buffer
+        if len(job_order) >= upper_bound:
+            while (len(job_order) > lower_bound) and not failed:
+                jobs_cond.wait()
         jobs_cond.release()
 
-        i += 2
+        i += 2 * size
+
+    # the last jobs may fail too, so wait for every range to be written
+    jobs_cond.acquire()
+    while job_order and not stopped:
+        if failed:
+            jobs_cond.release()
+            stopped = not resubmit_failed()
+            jobs_cond.acquire()
+        else:
+            jobs_cond.wait()
+    unfinished = list(pending_jobs.values())
+    jobs_cond.release()
+    if stopped:
+        for job in unfinished:
+            cluster.cancel(job)
 
     cluster.wait()
+    if (saver is not None):
+        jobs_cond.acquire()
+        save_checkpoint(force=True)
+        jobs_cond.release()
+    if output is not None:
+        output.close()
+
+    if auto_tune and (primality == 3):
+        print(('job size tuned to %i odd numbers per sieve job from %i samples (overhead %.3f sec, %.3e sec per number)' % (granularity, len(tune_samples), tune_overhead, tune_cost) ))
+    elif auto_tune:
+        print(('job granularity tuned to %i numbers per job from %i samples (overhead %.3f sec, %.3e sec per number)' % (granularity, len(tune_samples), tune_overhead, tune_cost) ))
+
+    if stopped:
+        print(('stopped with the primes below %i written, after a job failed %i times' % (written_upto, max_attempts)))
+    if prefilter:
+        print(('small prime prefilter: %i screened, %i rejected by trial division, %i rejected by gcd, %i passed to the full test' % tuple(prefilter_counts)))
 
     cluster.print_status()
     cluster.close()
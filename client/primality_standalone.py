@@ -1,7 +1,8 @@
 # Primality test algorithms
 # This code generates an endless list of prime numbers from a starting value
-# provided at run time. Both Miller-Rabin and Fermat have to be true for the
-# value to be assumed to be prime. It runs on the OctaPi client standalone
+# provided at run time. A sieve over a window ahead of the current value
+# rejects most candidates, and a deterministic Miller-Rabin test (Baillie-PSW
+# for very large values) decides on the rest. It runs on the OctaPi client standalone
 # and is intended to check that the primality testing code used in several
 # other apps is working correctly.
 #
@@ -20,125 +21,181 @@
 
 # All other original code: Crown Copyright 2016, 2017 
 
+# the tests shared by the standalone scripts (see primality_tests.py)
+from primality_tests import DeterministicPrimalityTest, smallPrimorial, smallPrimeFilter
 
-def naivePrimaryTest(number):
-    import math
-
-    if number == 2:
-       return true
-    if number % 2 == 0:
-        return False
-    
-    i = 3
-    sqrtOfNumber = math.sqrt(number)
-    
-    while i <= sqrtOfNumber:
-        if number % i == 0:
-            return False
-        i = i+2
-        
-    return True
-
-
-def FermatPrimalityTest(number):
-    import random, math
-
-    # if number != 1
-    if (number > 1):
-        # repeat the test few times
-        for time in range(3):
-            # Draw a RANDOM number in range of number ( Z_number )
-            randomNumber = random.randint(2, number)-1
-            
-            # Test if a^(n-1) = 1 mod n
-            if ( pow(randomNumber, number-1, number) != 1 ):
-                return False
-        
-        return True
-    else:
-        # case number == 1
-        return False
-
-def MillerRabinPrimalityTest(number):
-    import random, math
-    
-    # because the algorithm input is ODD number than if we get
-    # even and it is the number 2 we return TRUE ( spcial case )
-    # if we get the number 1 we return false and any other even 
-    # number we will return false.
-    
-    if number == 2:
-        return True
-    elif number == 1 or number % 2 == 0:
-        return False
-    
-    # first we want to express n as : 2^s * r ( were r is odd )
-    
-    # the odd part of the number
-    oddPartOfNumber = number - 1
-    
-    # The number of time that the number is divided by two
-    timesTwoDividNumber = 0
-    
-    # while r is even divid by 2 to find the odd part
-    while oddPartOfNumber % 2 == 0:
-        oddPartOfNumber = oddPartOfNumber // 2
-        timesTwoDividNumber = timesTwoDividNumber + 1 
-     
-    
-    # since there are number that are cases of "strong liar" we 
-    # need to check more then one number
-    
-    for time in range(3):
-        
-        # choose "Good" random number
-        while True:
-            # Draw a RANDOM number in range of number ( Z_number )
-            randomNumber = random.randint(2, number)-1
-            if randomNumber != 0 and randomNumber != 1:
-                break
-        
-        # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-        randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
-        
-        # if random number is not 1 and not -1 ( in mod n ) 
-        if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
-            # number of iteration
-            iterationNumber = 1
-            
-            # while we can squre the number and the squered number is not -1 mod number
-            while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
-                # squre the number
-                randomNumberWithPower = pow(randomNumberWithPower, 2, number)
-                
-                # inc the number of iteration
-                iterationNumber = iterationNumber + 1
-                
-            # if x != -1 mod number then it because we did not found strong witnesses
-            # hence 1 have more then two roots in mod n ==>
-            # n is composite ==> return false for primality
-            
-            if (randomNumberWithPower != (number - 1)):
-                return False
-            
-    # well the number pass the tests ==> it is probably prime ==> return true for primality
-    return True 
+
+# endless generator of the primes >= start, yielded lazily in order. The
+# odd numbers are sieved in windows of 'window' with the primes up to
+# 'limit', one window ahead of the cursor, and only the survivors are
+# tested; a survivor below (limit + 1)^2 has no factor left to find, so
+# while the windows stay below that the sieve alone proves them prime.
+# 'test' maps a list of survivors to True/False (map, or a process pool's
+# map), windows the prime cache already holds are read from 'cache', and
+# 'stats' keeps the totals of candidates, candidates rejected by the
+# sieve, survivors tested and primes yielded
+def primes_from(start, window=65536, limit=65536, test=None, cache=None, stats=None):
+    import bisect, collections, itertools, math
+
+    if test is None:
+        test = lambda numbers: map(DeterministicPrimalityTest, numbers)
+    if stats is None:
+        stats = {'candidates': 0, 'sieved': 0, 'tested': 0, 'primes': 0}
+
+    # base primes, by a plain sieve up to 'limit'
+    flags = bytearray(b'\x01') * (limit + 1)
+    for p in range(2, math.isqrt(limit) + 1):
+        if flags[p]:
+            flags[p * p::p] = bytes(len(range(p * p, limit + 1, p)))
+    base = [p for p in range(3, limit + 1, 2) if flags[p]]
+    proven = (limit + 1) ** 2
+    zeros = bytes(window)
+
+    # the primes of the window from odd 'number', as an iterator; the tests
+    # of the unproven survivors are started straight away
+    def sieveWindow(number):
+        upper = number + 2 * window - 2
+        if (cache is not None):
+            primes = cache.primes_in_range(number, upper)
+            if (primes is not None):
+                return iter(primes)
+
+        flags = bytearray(b'\x01') * window
+        for p in base:
+            # first odd multiple of p in this window, but not below p*p
+            m = max(p * p, (number + p - 1) // p * p)
+            if (m % 2) == 0:
+                m += p
+            k = (m - number) // 2
+            if k < window:
+                flags[k::p] = zeros[:(window - 1 - k) // p + 1]
+        if number == 1:
+            flags[0] = 0    # 1 is not prime
+
+        survivors = list(itertools.compress(range(number, upper + 1, 2), flags))
+        stats['candidates'] += window
+        stats['sieved'] += window - len(survivors)
+        split = bisect.bisect_left(survivors, proven)
+        unproven = survivors[split:]
+        stats['tested'] += len(unproven)
+        return itertools.chain(survivors[:split], itertools.compress(unproven, test(unproven)))
+
+    if start <= 2:
+        stats['primes'] += 1
+        yield 2
+    number = max(start, 3) | 1
+
+    # keep the next window sieved and under test while this one is read
+    windows = collections.deque()
+    while True:
+        while len(windows) < 2:
+            windows.append(sieveWindow(number))
+            number += 2 * window
+        for prime in windows.popleft():
+            stats['primes'] += 1
+            yield prime
+
+# the previous engine, for comparison: every odd number from 'start' goes
+# through 'smallPrimeFilter' and then the full test, in windows of
+# 'window'; 'stats' is kept as for 'primes_from', with the prefilter in
+# place of the sieve, and 'counts' has its breakdown
+def primes_tested_from(start, window=4096, test=None, cache=None, stats=None, counts=None):
+    import collections, itertools
+
+    if test is None:
+        test = lambda numbers: map(DeterministicPrimalityTest, numbers)
+    if stats is None:
+        stats = {'candidates': 0, 'sieved': 0, 'tested': 0, 'primes': 0}
+    if counts is None:
+        counts = [0, 0, 0, 0]
+    primorial = smallPrimorial()
+
+    number = start
+    if (number == 0):    # avoid zero
+         number = 1
+    elif (number % 2) == 0:    # make sure we start with an odd number
+         number += 1
+
+    # keep the next window queued so that the processes never run dry
+    windows = collections.deque()
+    while True:
+        while len(windows) < 2:
+            primes = None
+            if (cache is not None):
+                primes = cache.primes_in_range(number, number + 2 * window - 2)
+            if (primes is not None):
+                windows.append((primes, itertools.repeat(True)))
+            else:
+                numbers = [n for n in range(number, number + 2 * window, 2) if smallPrimeFilter(n, primorial, counts)]
+                stats['candidates'] += window
+                stats['sieved'] += window - len(numbers)
+                stats['tested'] += len(numbers)
+                windows.append((numbers, test(numbers)))
+            number += 2 * window
+
+        numbers, results = windows.popleft()
+        for candidate, isprime in zip(numbers, results):
+            # test for primility
+            if isprime:
+                stats['primes'] += 1
+                yield candidate
+
+# one line rate report: primes found per second, and how many of the
+# candidates were rejected before they reached a test
+def rateReport(stats, seconds):
+    rejected = (100.0 * stats['sieved'] / stats['candidates']) if stats['candidates'] else 0.0
+    return ('%i primes in %.1fs, %.0f primes/s; %i candidates, %i (%.1f%%) rejected by the sieve, %i tested'
+            % (stats['primes'], seconds, stats['primes'] / max(seconds, 1e-9), stats['candidates'], stats['sieved'], rejected, stats['tested']))
 
 
 # main loop
-# get number to test
-print("Enter the number you want to start from:")
-number = int(eval(input()))
-
-if (number == 0):    # avoid zero
-     number = 1
-elif (number % 2) == 0:    # make sure we start with an odd number
-     number += 1 
-
-while True:
-    
-    # test for primility
-    if MillerRabinPrimalityTest(number) and FermatPrimalityTest(number):
-        print(number)
-
-    number += 2
\ No newline at end of file
+if __name__ == '__main__':
+    import argparse, concurrent.futures, sys, time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of local processes to run the tests on")
+    parser.add_argument("--cache", help="prime cache file; windows it already holds are read from it")
+    parser.add_argument("--engine", choices=["sieve", "test"], default="sieve", help="sieve a window ahead and test only the survivors, or prefilter and test every odd number")
+    parser.add_argument("--report", type=float, default=0, help="seconds between rate reports on stderr; 0 reports only on Ctrl-C")
+    args = parser.parse_args()
+
+    workers = args.workers
+
+    # windows that the prime cache already holds are read from it and
+    # only the rest are sieved and tested here; nothing is sieved into it
+    cache = None
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache, fill_limit=0)
+
+    # get number to test
+    print("Enter the number you want to start from:")
+    number = int(eval(input()))
+
+    # the tests are handed out to the processes in chunks; results come
+    # back in order within a window
+    if (workers > 1):
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        test = lambda numbers: executor.map(DeterministicPrimalityTest, numbers, chunksize=256)
+    else:
+        test = lambda numbers: map(DeterministicPrimalityTest, numbers)
+
+    stats = {'candidates': 0, 'sieved': 0, 'tested': 0, 'primes': 0}
+    prefilter_counts = [0, 0, 0, 0]
+    if (args.engine == 'sieve'):
+        primes = primes_from(number, window=max(65536, 4096 * workers), test=test, cache=cache, stats=stats)
+    else:
+        primes = primes_tested_from(number, window=4096 * workers, test=test, cache=cache, stats=stats, counts=prefilter_counts)
+
+    started = time.monotonic()
+    reported = started
+    try:
+        for prime in primes:
+            print(prime)
+            if args.report and (time.monotonic() - reported) >= args.report:
+                reported = time.monotonic()
+                print(rateReport(stats, reported - started), file=sys.stderr)
+    except KeyboardInterrupt:
+        print(rateReport(stats, time.monotonic() - started), file=sys.stderr)
+        if (args.engine == 'test'):
+            print(('small prime prefilter: %i screened, %i rejected by trial division, %i rejected by gcd, %i passed to the full test' % tuple(prefilter_counts)), file=sys.stderr)
@@ -0,0 +1,175 @@
+# Primality tests for the standalone scripts
+# primality_standalone.py, factor_standalone.py and semi_prime_standalone.py
+# all decide primality the same way, so they share this one copy. The
+# functions dispy ships to the nodes have to be self-contained, so
+# primality_efficient.py, primality_canonical.py and factor_efficient.py
+# keep their own copies inside the node functions.
+#
+#   DeterministicPrimalityTest(n)          True if n is prime
+#   smallPrimorial(limit)                  product of the primes 17 .. limit
+#   smallPrimeFilter(n, primorial, counts) False if n has a small factor
+#
+# Derived from code by Shay Margalit, 12 Dec 2013, under the Code Project
+# Open License (CPOL) 1.02, see primality_standalone.py
+#
+# Usage:
+#   from primality_tests import DeterministicPrimalityTest
+
+# GMP arithmetic where gmpy2 is installed, chosen once (see arithmetic.py)
+from arithmetic import is_strong_prp, is_strong_selfridge_prp
+
+
+# deterministic primality test: Miller-Rabin with fixed witness sets
+# that are proven exact below 3.3e24, and Baillie-PSW (a strong base 2
+# test plus a strong Lucas test) above that
+def DeterministicPrimalityTest(number):
+    import math
+
+    # strong probable prime test of 'number' to base 'a', where
+    # number - 1 = oddPartOfNumber * 2^timesTwoDividNumber
+    def strongProbablePrime(a, oddPartOfNumber, timesTwoDividNumber):
+        if (is_strong_prp is not None) and (a > 1):
+            return is_strong_prp(number, a)
+        x = pow(a, oddPartOfNumber, number)
+        if (x == 1) or (x == number - 1):
+            return True
+        for iterationNumber in range(timesTwoDividNumber - 1):
+            x = x * x % number
+            if (x == number - 1):
+                return True
+        return False
+
+    # Jacobi symbol (a/n) for odd n > 0
+    def jacobi(a, n):
+        a = a % n
+        result = 1
+        while a != 0:
+            while a % 2 == 0:
+                a = a // 2
+                if n % 8 in (3, 5):
+                    result = -result
+            a, n = n, a
+            if (a % 4 == 3) and (n % 4 == 3):
+                result = -result
+            a = a % n
+        return result if n == 1 else 0
+
+    # strong Lucas probable prime test with Selfridge's parameters
+    def strongLucasProbablePrime():
+        # a square has no suitable D, and is not prime anyway
+        if math.isqrt(number) ** 2 == number:
+            return False
+
+        if (is_strong_selfridge_prp is not None):
+            return is_strong_selfridge_prp(number)
+
+        # first D in 5, -7, 9, -11, ... with (D/number) = -1
+        D = 5
+        while True:
+            j = jacobi(D, number)
+            if (j == -1):
+                break
+            if (j == 0) and (abs(D) != number):
+                return False    # D shares a factor with number
+            D = -D - 2 if D > 0 else -D + 2
+        P, Q = 1, (1 - D) // 4
+
+        # number + 1 = d * 2^s with d odd
+        d, s = number + 1, 0
+        while d % 2 == 0:
+            d, s = d // 2, s + 1
+
+        # U_d and V_d by the binary method, halving modulo an odd number
+        def half(x):
+            x = x % number
+            return (x + number) // 2 if x % 2 else x // 2
+
+        U, V, Qk = 1, P, Q % number
+        for bit in bin(d)[3:]:
+            U, V = U * V % number, (V * V - 2 * Qk) % number
+            Qk = Qk * Qk % number
+            if bit == '1':
+                U, V = half(P * U + V), half(D * U + P * V)
+                Qk = Qk * Q % number
+
+        if (U == 0) or (V == 0):
+            return True
+        for r in range(s - 1):
+            V = (V * V - 2 * Qk) % number
+            Qk = Qk * Qk % number
+            if (V == 0):
+                return True
+        return False
+
+    if number < 2:
+        return False
+    # trial divide by the small primes, which are also the witnesses below
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41):
+        if number % p == 0:
+            return number == p
+
+    # express number - 1 as 2^s * r ( were r is odd ), exactly
+    oddPartOfNumber = number - 1
+    timesTwoDividNumber = (oddPartOfNumber & -oddPartOfNumber).bit_length() - 1
+    oddPartOfNumber = oddPartOfNumber >> timesTwoDividNumber
+
+    # these witness sets are proven to have no strong liars below the
+    # limit, so the answer is exact rather than probable
+    if number < 2047:
+        witnesses = (2,)
+    elif number < 1373653:
+        witnesses = (2, 3)
+    elif number < 25326001:
+        witnesses = (2, 3, 5)
+    elif number < 3215031751:
+        witnesses = (2, 3, 5, 7)
+    elif number < 2152302898747:
+        witnesses = (2, 3, 5, 7, 11)
+    elif number < 3474749660383:
+        witnesses = (2, 3, 5, 7, 11, 13)
+    elif number < 341550071728321:
+        witnesses = (2, 3, 5, 7, 11, 13, 17)
+    elif number < 18446744073709551616:    # 2^64
+        witnesses = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+    elif number < 3317044064679887385961981:
+        witnesses = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+    else:
+        # Baillie-PSW: no composite is known to pass both of these
+        return strongProbablePrime(2, oddPartOfNumber, timesTwoDividNumber) and strongLucasProbablePrime()
+
+    for a in witnesses:
+        if (a % number != 0) and not strongProbablePrime(a % number, oddPartOfNumber, timesTwoDividNumber):
+            return False
+    return True
+
+
+# product of the primes from 17 up to 'limit', so that 'smallPrimeFilter'
+# can screen a candidate against all of them with a single gcd
+def smallPrimorial(limit=1000):
+    primorial = 1
+    for p in range(17, limit, 2):
+        if all(p % q for q in range(3, int(p ** 0.5) + 1, 2)):
+            primorial *= p
+    return primorial
+
+# cheap screen in front of the modular exponentiation tests: trial division
+# by the primes below 17, then one gcd against 'primorial'. Returns False
+# if 'number' has a small factor, so is composite, and True if it still
+# needs a full test. 'counts' keeps the totals screened, rejected by trial
+# division, rejected by the gcd and passed on to the full test
+def smallPrimeFilter(number, primorial, counts):
+    import math
+
+    counts[0] += 1
+    if number < 1000:    # may be one of the small primes itself
+        counts[3] += 1
+        return True
+    for p in (2, 3, 5, 7, 11, 13):
+        if number % p == 0:
+            counts[1] += 1
+            return False
+    if math.gcd(number, primorial) != 1:
+        counts[2] += 1
+        return False
+    counts[3] += 1
+    return True
@@ -0,0 +1,204 @@
+# Prime cache
+# An on-disk store of known primality for the odd numbers, shared by the
+# primality, factoring and semi-prime scripts so that ranges which have
+# been sieved once are never sieved or tested again.
+#
+# The odd numbers are split into segments of 'segment_size' odd numbers;
+# segment s covers 2 * s * segment_size + 1, + 3, ... and is kept as a bit
+# packed table in the same form as 'segmentedSieve' returns, with bit k
+# set if the k-th odd number of the segment is prime. The file is a
+# header followed by (segment number, table) records that are appended
+# as segments are computed, and it is read through mmap, so a lookup is
+# a single page read.
+#
+# Segments are sieved here on demand, with base primes taken from the
+# lower segments of the cache itself, up to 'fill_limit'; above that the
+# queries return None for segments nobody has stored and the caller has
+# to fall back to its own tests.
+#
+# Usage:
+#   cache = PrimeCache('primes.cache')
+#   cache.is_prime(1000003), cache.next_prime(10 ** 12)
+#   cache.primes_in_range(1000000, 1100000)
+
+import os, mmap, struct, fcntl, math
+
+MAGIC = b'OPPRIME1'
+HEADER = struct.Struct('<8sQ')    # magic, odd numbers per segment
+RECORD = struct.Struct('<Q')      # segment number, then the table
+
+class PrimeCache(object):
+    def __init__(self, path, segment_size=1048576, fill_limit=1 << 48):
+        self.path = path
+        self.fill_limit = fill_limit
+        self.index = {}    # segment number to offset of its table
+        self.scanned = HEADER.size
+        self.map = None
+
+        # the first run writes the header, later runs take the segment
+        # size from it
+        with open(path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                f.truncate(0)
+                f.write(HEADER.pack(MAGIC, segment_size))
+            else:
+                magic, segment_size = HEADER.unpack(header)
+                if magic != MAGIC:
+                    raise ValueError('%s is not a prime cache file' % path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        self.segment_size = segment_size
+        self.table_size = (segment_size + 7) // 8
+        self.record_size = RECORD.size + self.table_size
+        self.refresh()
+
+    # pick up the records appended since the last scan, by this or by any
+    # other process, and map the file again to cover them
+    def refresh(self):
+        size = os.path.getsize(self.path)
+        if (size - self.scanned) < self.record_size:
+            return
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # a record cut short by a crash is ignored, and replaced by the next append
+        while (self.scanned + self.record_size) <= len(self.map):
+            segment, = RECORD.unpack_from(self.map, self.scanned)
+            self.index.setdefault(segment, self.scanned + RECORD.size)
+            self.scanned += self.record_size
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    # first odd number of a segment and the segment holding odd number n
+    def segment_start(self, segment):
+        return 2 * segment * self.segment_size + 1
+
+    def segment_of(self, n):
+        return (n // 2) // self.segment_size
+
+    # offset of the stored table of a segment in the map, or None if it
+    # is not in the cache
+    def lookup(self, segment):
+        if segment not in self.index:
+            self.refresh()
+        return self.index.get(segment)
+
+    # append the table of a whole segment, unless another run got there first
+    def store(self, segment, table):
+        if len(table) != self.table_size:
+            raise ValueError('a segment table is %i bytes, not %i' % (self.table_size, len(table)))
+        with open(self.path, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.refresh()
+            if segment not in self.index:
+                f.truncate(self.scanned)
+                f.seek(self.scanned)
+                f.write(RECORD.pack(segment) + bytes(table))
+                f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+        self.refresh()
+
+    # offset of the table of a segment, which is sieved and stored if it
+    # is missing; None if it is missing and beyond 'fill_limit'
+    def fetch(self, segment):
+        offset = self.lookup(segment)
+        if offset is None:
+            start = self.segment_start(segment)
+            if (start + 2 * self.segment_size) > self.fill_limit:
+                return None
+            self.store(segment, self.sieve(start))
+            offset = self.lookup(segment)
+        return offset
+
+    # Sieve of Eratosthenes over the odd numbers of one segment; the base
+    # primes come from the cache, except for the first segment which
+    # holds its own base primes
+    def sieve(self, start):
+        count = self.segment_size
+        limit = math.isqrt(start + 2 * count)
+        if limit < start:
+            primes = self.primes_in_range(3, limit)
+        else:
+            primes = [p for p in range(3, limit + 1, 2) if all(p % q for q in range(3, math.isqrt(p) + 1, 2))]
+
+        flags = bytearray(b'\x01') * count
+        zeros = bytes(count)
+        for p in primes:
+            # first odd multiple of p in this segment, but not below p*p
+            m = max(p * p, (start + p - 1) // p * p)
+            if (m % 2) == 0:
+                m += p
+            k = (m - start) // 2
+            if k < count:
+                flags[k::p] = zeros[:(count - 1 - k) // p + 1]
+        if start == 1:
+            flags[0] = 0    # 1 is not prime
+
+        # pack one flag per bit, bit k of the result is flags[k]
+        bits = int(flags[::-1].translate(bytes.maketrans(b'\x00\x01', b'01')), 2)
+        return bits.to_bytes(self.table_size, 'little')
+
+    # True or False, or None if the answer is not in the cache and
+    # cannot be added to it; reads the one byte holding n's bit
+    def is_prime(self, n):
+        if n < 3:
+            return n == 2
+        if (n % 2) == 0:
+            return False
+        offset = self.fetch(self.segment_of(n))
+        if offset is None:
+            return None
+        k = (n // 2) % self.segment_size
+        return bool((self.map[offset + (k >> 3)] >> (k & 7)) & 1)
+
+    # odd primes p with lower <= p <= upper in one segment, both limits odd
+    def segment_primes(self, segment, lower, upper):
+        offset = self.fetch(segment)
+        if offset is None:
+            return None
+        start = self.segment_start(segment)
+        first = max(lower - start, 0) // 2
+        last = min(upper - start, 2 * self.segment_size - 2) // 2
+        primes = []
+        for i in range(first >> 3, (last >> 3) + 1):
+            byte = self.map[offset + i]
+            if byte:
+                for bit in range(8):
+                    if ((byte >> bit) & 1) and (first <= (8 * i + bit) <= last):
+                        primes.append(start + 2 * (8 * i + bit))
+        return primes
+
+    # the smallest prime >= n, or None if the search leaves the cache
+    def next_prime(self, n):
+        if n <= 2:
+            return 2
+        if (n % 2) == 0:
+            n += 1
+        segment = self.segment_of(n)
+        while True:
+            primes = self.segment_primes(segment, n, self.segment_start(segment + 1) - 2)
+            if primes is None:
+                return None
+            if primes:
+                return primes[0]
+            segment += 1
+
+    # all primes p with lower <= p <= upper, or None if part of the range
+    # is not in the cache and cannot be added to it
+    def primes_in_range(self, lower, upper):
+        primes = [2] if lower <= 2 <= upper else []
+        lower = max(lower, 3) | 1
+        upper = upper - 1 + (upper % 2)
+        for segment in range(self.segment_of(lower), self.segment_of(upper) + 1):
+            found = self.segment_primes(segment, lower, upper)
+            if found is None:
+                return None
+            primes += found
+        return primes
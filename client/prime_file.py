@@ -0,0 +1,245 @@
+# Prime list files
+# A compact binary format for ascending lists of primes, as written by the
+# primality scripts with --binary, at about one byte per prime rather than
+# the 10-20 bytes of one decimal number per line.
+#
+# The file starts with MAGIC and holds a run of segments, each of them
+#   b'S', varint first prime, varint count, varint payload length, payload
+# where the payload is the varint half-gaps (p - previous) / 2 between the
+# count primes of the segment; a half-gap of 0 stands for the step from 2
+# to 3. Closing the file adds an index of the segments,
+#   b'I', varint segments, then varint first prime, offset, count for each
+# and a footer of the index offset and END, so that a reader can seek to
+# the segment holding a given value. A file that is still being written
+# (or was never closed) has no index yet and is read by walking the
+# segment headers instead.
+#
+# Usage:
+#   python3 prime_file.py encode primes.txt primes.bin
+#   python3 prime_file.py decode primes.bin primes.txt [--start N]
+
+import os, mmap, struct, bisect
+
+MAGIC = b'OPPLIST1'
+END = b'OPPLEND1'
+FOOTER = struct.Struct('<Q8s')    # index offset, END
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+# the value of the varint at data[offset], and the offset after it
+def decode_varint(data, offset):
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+# write primes, in ascending order, to a prime list file; with 'offset'
+# (from 'sync'), carry on with a file an earlier run wrote up to there,
+# dropping anything written after it
+class PrimeWriter(object):
+    def __init__(self, path, segment_primes=65536, offset=None):
+        self.segment_primes = segment_primes
+        self.index = []    # (first prime, offset, count) of each segment
+        self.first = None
+        self.previous = None
+        if offset is None:
+            self.file = open(path, 'wb')
+            self.file.write(MAGIC)
+        else:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+            with PrimeReader(path) as reader:
+                self.index = list(reader.segments)
+                if self.index:
+                    for prime in reader.segment(len(self.index) - 1):
+                        self.previous = prime    # the last prime written
+            self.file = open(path, 'ab')
+        self.count = 0
+        self.payload = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, prime):
+        if (self.previous is not None) and (prime <= self.previous):
+            raise ValueError('primes must be written in ascending order, %i after %i' % (prime, self.previous))
+        if self.first is None:
+            self.first = prime
+        else:
+            self.payload += encode_varint((prime - self.previous) // 2)
+        self.previous = prime
+        self.count += 1
+        if self.count >= self.segment_primes:
+            self.end_segment()
+
+    def end_segment(self):
+        if self.count == 0:
+            return
+        self.index.append((self.first, self.file.tell(), self.count))
+        self.file.write(b'S' + encode_varint(self.first) + encode_varint(self.count) + encode_varint(len(self.payload)))
+        self.file.write(self.payload)
+        self.first, self.count, self.payload = None, 0, bytearray()
+
+    # whole segments are on disk after a flush, the one being filled is not
+    def flush(self):
+        self.file.flush()
+
+    # end the segment being filled and flush, so that every prime written
+    # so far is on disk; returns the length of the file, for 'offset'
+    def sync(self):
+        self.end_segment()
+        self.flush()
+        return self.file.tell()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.end_segment()
+        offset = self.file.tell()
+        self.file.write(b'I' + encode_varint(len(self.index)))
+        for first, segment_offset, count in self.index:
+            self.file.write(encode_varint(first) + encode_varint(segment_offset) + encode_varint(count))
+        self.file.write(FOOTER.pack(offset, END))
+        self.file.close()
+
+# the same interface, for one decimal prime per line
+class TextPrimeWriter(object):
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, prime):
+        self.file.write('%i\n' % prime)
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.flush()
+        if self.file.fileno() > 2:    # leave stdout open
+            self.file.close()
+
+# read a prime list file; the segments are found from the index, or by
+# walking the segment headers of a file without one. The file is read
+# through mmap, so only the pages of the index (or the headers) and of
+# the segments actually iterated over are read from disk
+class PrimeReader(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(MAGIC):
+                raise ValueError('%s is not a prime list file' % path)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a prime list file' % path)
+
+        self.segments = []    # (first prime, offset, count)
+        offset, end = FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size) if len(self.data) >= len(MAGIC) + FOOTER.size else (0, b'')
+        if (end == END) and (self.data[offset:offset + 1] == b'I'):
+            total, offset = decode_varint(self.data, offset + 1)
+            for i in range(total):
+                first, offset = decode_varint(self.data, offset)
+                segment_offset, offset = decode_varint(self.data, offset)
+                count, offset = decode_varint(self.data, offset)
+                self.segments.append((first, segment_offset, count))
+        else:
+            offset = len(MAGIC)
+            while self.data[offset:offset + 1] == b'S':
+                try:
+                    first, position = decode_varint(self.data, offset + 1)
+                    count, position = decode_varint(self.data, position)
+                    length, position = decode_varint(self.data, position)
+                except IndexError:
+                    break    # a header cut short
+                if (position + length) > len(self.data):
+                    break    # a segment still being written
+                self.segments.append((first, offset, count))
+                offset = position + length
+        self.firsts = [first for first, offset, count in self.segments]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return sum([count for first, offset, count in self.segments])
+
+    def __iter__(self):
+        return self.primes()
+
+    # the primes of one segment, lazily
+    def segment(self, number):
+        first, offset, count = self.segments[number]
+        position = offset + 1
+        for field in range(3):    # first prime, count and payload length
+            value, position = decode_varint(self.data, position)
+        prime = first
+        yield prime
+        for i in range(count - 1):
+            half, position = decode_varint(self.data, position)
+            prime = prime + 2 * half if half else prime + 1
+            yield prime
+
+    # the primes >= start, lazily, starting from the segment that holds start
+    def primes(self, start=0):
+        for number in range(max(bisect.bisect_right(self.firsts, start) - 1, 0), len(self.segments)):
+            for prime in self.segment(number):
+                if prime >= start:
+                    yield prime
+
+# converters to and from one decimal prime per line
+def text_to_primes(text_path, prime_path):
+    with open(text_path) as text, PrimeWriter(prime_path) as writer:
+        for line in text:
+            if line.strip():
+                writer.write(int(line))
+
+def primes_to_text(prime_path, text_path, start=0):
+    with open(text_path, 'w') as text, PrimeReader(prime_path) as reader:
+        for prime in reader.primes(start):
+            text.write('%i\n' % prime)
+
+
+# main
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=["encode", "decode"], help="encode a text list into a prime list file, or decode one to text")
+    parser.add_argument("source", help="file to read")
+    parser.add_argument("target", help="file to write")
+    parser.add_argument("--start", type=int, default=0, help="decode only the primes from this value on")
+    args = parser.parse_args()
+
+    if (args.action == 'encode'):
+        text_to_primes(args.source, args.target)
+    else:
+        primes_to_text(args.source, args.target, args.start)
+    print(('%s: %i bytes' % (args.target, os.path.getsize(args.target))))
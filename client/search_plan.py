@@ -0,0 +1,73 @@
+# Search plans for the factoring scripts
+# The smaller prime factor of a semi-prime is at most its square root, so
+# the trial method only needs to cover 3 .. isqrt(semi-prime). A plan is a
+# generator of (lower, upper) chunks over that range, both limits odd and
+# inclusive, in the order they should be searched; it calls size() for
+# the length of each chunk, so that a tuner can change it as the search
+# goes. New orderings are added to PLANS.
+#
+#   down        from the square root downwards, nearest to balanced first
+#   interleave  alternately a chunk down from the square root and one up
+#               from 3, for factors that may be unbalanced
+#   up          from the square root upwards to semi-prime / 2, looking
+#               for the larger factor (the original search order)
+#
+# Usage:
+#   for lower, upper in PLANS['down'](semi_prime, lambda: chunk):
+#       find_factor(semi_prime, lower, upper)
+
+import math
+
+# the odd number at or below n, and at or above n
+def odd_below(n):
+    return n if (n % 2) else n - 1
+
+def odd_above(n):
+    return n if (n % 2) else n + 1
+
+def plan_down(semi_prime, size):
+    upper = odd_below(math.isqrt(semi_prime))
+    while upper >= 3:
+        lower = max(odd_above(upper - size()), 3)
+        yield (lower, upper)
+        upper = lower - 2
+
+def plan_interleave(semi_prime, size):
+    top = odd_below(math.isqrt(semi_prime))    # next chunk down ends here
+    bottom = 3                                 # next chunk up starts here
+    down = True
+    while bottom <= top:
+        if down:
+            lower = max(odd_above(top - size()), bottom)
+            yield (lower, top)
+            top = lower - 2
+        else:
+            upper = min(odd_below(bottom + size()), top)
+            yield (bottom, upper)
+            bottom = upper + 2
+        down = not down
+
+def plan_up(semi_prime, size):
+    lower = odd_above(math.isqrt(semi_prime))
+    limit = semi_prime // 2
+    while lower <= limit:
+        upper = min(odd_below(lower + size()), odd_below(limit))
+        yield (lower, upper)
+        lower = upper + 2
+
+# the range a plan covers, as (lower, upper), for working out how much
+# of the search is left
+def plan_span(name, semi_prime):
+    if name == 'up':
+        return (odd_above(math.isqrt(semi_prime)), semi_prime // 2)
+    return (3, math.isqrt(semi_prime))
+
+# consecutive chunks of every integer in lower .. upper, for searches
+# such as Fermat's that are not over odd candidates
+def plan_range(lower, upper, size):
+    while lower <= upper:
+        last = min(lower + size(), upper)
+        yield (lower, last)
+        lower = last + 1
+
+PLANS = {'down': plan_down, 'interleave': plan_interleave, 'up': plan_up}
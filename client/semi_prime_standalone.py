@@ -17,115 +17,38 @@
 
 # All other original code: Crown Copyright 2016, 2017 
 
+# the tests shared by the standalone scripts (see primality_tests.py)
+from primality_tests import DeterministicPrimalityTest
 
 
-def naivePrimalityTest(number):
-    import math
+# pick a random prime with this number of digits: random odd values are
+# tried until one is prime, so every odd prime of that size is as likely;
+# the prime cache, where it holds a value, answers in place of the test
+def pickPrime(digits, cache):
+    import random
 
-    if number == 2:
-       return true
-    if number % 2 == 0:
-        return False
-    
-    i = 3
-    sqrtOfNumber = math.sqrt(number)
-    
-    while i <= sqrtOfNumber:
-        if number % i == 0:
-            return False
-        i = i+2
-        
-    return True
-
-
-def FermatPrimalityTest(number):
-    import random, math
-
-    # if number != 1
-    if (number > 1):
-        # repeat the test few times
-        for time in range(3):
-            # Draw a RANDOM number in range of number ( Z_number )
-            randomNumber = random.randint(2, number)-1
-            
-            # Test if a^(n-1) = 1 mod n
-            if ( pow(randomNumber, number-1, number) != 1 ):
-                return False
-        
-        return True
-    else:
-        # case number == 1
-        return False
-
-def MillerRabinPrimalityTest(number):
-    import random, math
-    
-    # because the algorithm input is ODD number than if we get
-    # even and it is the number 2 we return TRUE ( spcial case )
-    # if we get the number 1 we return false and any other even 
-    # number we will return false.
-    
-    if number == 2:
-        return True
-    elif number == 1 or number % 2 == 0:
-        return False
-    
-    # first we want to express n as : 2^s * r ( were r is odd )
-    
-    # the odd part of the number
-    oddPartOfNumber = number - 1
-    
-    # The number of time that the number is divided by two
-    timesTwoDividNumber = 0
-    
-    # while r is even divid by 2 to find the odd part
-    while oddPartOfNumber % 2 == 0:
-        oddPartOfNumber = oddPartOfNumber // 2
-        timesTwoDividNumber = timesTwoDividNumber + 1 
-     
-    
-    # since there are number that are cases of "strong liar" we 
-    # need to check more then one number
-    
-    for time in range(3):
-        
-        # choose "Good" random number
-        while True:
-            # Draw a RANDOM number in range of number ( Z_number )
-            randomNumber = random.randint(2, number)-1
-            if randomNumber != 0 and randomNumber != 1:
-                break
-        
-        # randomNumberWithPower = randomNumber^oddPartOfNumber mod number 
-        randomNumberWithPower = pow(randomNumber, oddPartOfNumber, number)
-        
-        # if random number is not 1 and not -1 ( in mod n ) 
-        if (randomNumberWithPower != 1) and (randomNumberWithPower != number - 1):
-            # number of iteration
-            iterationNumber = 1
-            
-            # while we can squre the number and the squered number is not -1 mod number
-            while (iterationNumber <= timesTwoDividNumber - 1) and (randomNumberWithPower != number - 1):
-                # squre the number
-                randomNumberWithPower = pow(randomNumberWithPower, 2, number)
-                
-                # inc the number of iteration
-                iterationNumber = iterationNumber + 1
-                
-            # if x != -1 mod number then it because we did not found strong witnesses
-            # hence 1 have more then two roots in mod n ==>
-            # n is composite ==> return false for primality
-            
-            if (randomNumberWithPower != (number - 1)):
-                return False
-            
-    # well the number pass the tests ==> it is probably prime ==> return true for primality
-    return True 
+    lower = max(pow(10, digits - 1), 2)
+    while True:
+        factor = random.randrange(lower | 1, pow(10, digits), 2)
+        prime = cache.is_prime(factor) if (cache is not None) else None
+        if (prime is None):
+            prime = DeterministicPrimalityTest(factor)
+        if prime:
+            return factor
 
 
 # main loop
 if __name__ == '__main__':
-    import random, math
+    import random, math, argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache", help="prime cache file to look the random picks up in, where it holds them")
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        import prime_cache
+        cache = prime_cache.PrimeCache(args.cache, fill_limit=0)    # look up, never sieve
 
     # same number of digits are use for both primes
     power1 = int( input( "How many digits in each Prime? " ) )
@@ -140,13 +63,9 @@ if __name__ == '__main__':
         exit(0)
 
     # select prime factor 1 with this number of digits
-    factor1 = int(random.uniform(pow(10, power1 - 1), pow(10, power1)))
-    while (MillerRabinPrimalityTest(factor1) == False):
-        factor1 = int(random.uniform(pow(10, power1 - 1), pow(10, power1)))
+    factor1 = pickPrime(power1, cache)
 
     # select prime factor 2 with this number of digits
-    factor2 = int(random.uniform(pow(10, power2 - 1), pow(10, power2)))
-    while (MillerRabinPrimalityTest(factor2) == False):
-        factor2 = int(random.uniform(pow(10, power2 - 1), pow(10, power2)))
+    factor2 = pickPrime(power2, cache)
 
     print(('%i * %i = %i' % (factor1, factor2, factor1*factor2)))